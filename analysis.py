@@ -81,6 +81,7 @@ if __name__ == "__main__":
     parser.add_argument('--model', help='folder containing parameters and weights of the model', default="models\\batch-size_16#epochs_50#grayscale_True#recon-loss_mse#heading-weight_0#test")
     # parser.add_argument('--out', help='name for output files')
     parser.add_argument('--grayscale', help='Boolean whether dataset should be loades as grayscale', default="True")
+    parser.add_argument('--dataset', help='dataset csv (e.g. one written by synthetic.py)', default="/mnt/masc_home/kressal/datasets/selfmotion/20220930-134704_1_ws.csv")
     # parser.add_argument('--res', help='Video resolution (res x res)', default=256)
     # parser.add_argument('--latent_dim', help='Boolean whether dataset should be loades as grayscale', default=None)
 
@@ -93,7 +94,7 @@ if __name__ == "__main__":
     if output_name == "retired":
         sys.exit()
 
-    autoencoder = VAE.load(args.model)
+    autoencoder = VAE.load(args.model, components=["encoder", "decoder", "heading_decoder"])
     latent_dim = autoencoder.latent_space_dim
     # autoencoder_c2 = VAE_c2.load("vae_sm_vid_c2")
     # autoencoder.summary()
@@ -102,9 +103,9 @@ if __name__ == "__main__":
     video_dim = autoencoder.input_shape
     print(video_dim)
     # dataset = "20221110-174245_1_ws.csv"
-    dataset = "20220930-134704_1_ws.csv"   # trainigset
+    dataset = os.path.basename(args.dataset)
     batch_size = 460
-    x_test = SelfmotionDataGenerator(f"/mnt/masc_home/kressal/datasets/selfmotion/{dataset}", batch_size, video_dim, grayscale=bw, shuffle=True)
+    x_test = SelfmotionDataGenerator(args.dataset, batch_size, video_dim, grayscale=bw, shuffle=True)
     # batch_size = 32
     # x_test = SelfmotionDataGenerator("N:\\Datasets\\selfmotion\\20220930-134704_1.csv", batch_size, video_dim, grayscale=bw, shuffle=True)
 
@@ -147,7 +148,7 @@ if __name__ == "__main__":
     plt.savefig(f"results/{output_name}_latent-heading_corr.png")
 
     latent_variations = latent_points + 1
-    variations = autoencoder.decoder.predict(latent_variations)
+    variations, _ = autoencoder.generate(latent_variations)
 
     # reconstructed_videos_c2, latent_points_c2 = autoencoder_c2.reconstruct(sample_videos)
 
@@ -205,8 +206,9 @@ if __name__ == "__main__":
     latent_points = np.array([[random.uniform(-2, 2) for j in range(int(latent_dim))] for i in range(num_samples)])
     # latent_points = np.array([random.uniform(-4, 4) for j in range(200)])
     print(latent_points.shape)
-    new_videos = autoencoder.decoder.predict(latent_points)
+    new_videos, new_headings = autoencoder.generate(latent_points)
     print(new_videos.shape)
+    print(f"Predicted heading: {new_headings[0]}")
     print(f"Predicted:      min: {np.min(new_videos[0])}        max: {np.max(new_videos[0])}        mean: {np.mean(new_videos[0])}")
     print(f"Latent Space:   min: {np.min(latent_points[0])}     max: {np.max(latent_points[0])}     mean: {np.mean(latent_points[0])}")
 
@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import numpy as np
+from sm_vae import VAE
+
+
+def time_call(fn, repeats):
+    # first call is excluded, it pays for tracing / building the predict function
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def _predict_reconstruct(vae, videos):
+    # the three predict calls VAE.reconstruct used to make
+    latents = vae.encoder.predict(videos, verbose=0)
+    return vae.decoder.predict(latents, verbose=0), latents, vae.heading_decoder.predict(latents, verbose=0)
+
+
+def benchmark_inference(vae, batch_sizes=(1, 64), repeats=20):
+    """
+    Seconds per call of Model.predict versus the traced VAE.encode / decode / predict_heading / reconstruct
+    for every batch size.
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        videos = np.random.uniform(0, 1, [batch_size] + list(vae.input_shape)).astype(np.float32)
+        latents = np.random.normal(0, 1, [batch_size, vae.latent_space_dim]).astype(np.float32)
+        calls = {
+            "encode": (lambda: vae.encoder.predict(videos, verbose=0), lambda: vae.encode(videos)),
+            "decode": (lambda: vae.decoder.predict(latents, verbose=0), lambda: vae.decode(latents)),
+            "predict_heading": (lambda: vae.heading_decoder.predict(latents, verbose=0), lambda: vae.predict_heading(latents)),
+            "reconstruct": (lambda: _predict_reconstruct(vae, videos), lambda: vae.reconstruct(videos)),
+            "generate": (lambda: (vae.decoder.predict(latents, verbose=0), vae.heading_decoder.predict(latents, verbose=0)), lambda: vae.generate(latents)),
+        }
+        for name, (predict, fast) in calls.items():
+            t_predict, t_fast = time_call(predict, repeats), time_call(fast, repeats)
+            results[f"{name}@{batch_size}"] = {"predict_s": t_predict, "fast_s": t_fast, "speedup": t_predict / t_fast}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inference benchmark: Model.predict vs. the traced VAE fast path')
+
+    parser.add_argument('--model', help='optional, folder containing parameters and weights of a model, an untrained model is built otherwise', default=None)
+    parser.add_argument('--res', help='resolution of frames of the untrained model (res x res)', default=64)
+    parser.add_argument('--latent-dim', help='dimensionality of latent space of the untrained model', default=180)
+    parser.add_argument('--xla', help='Boolean whether the fast path is compiled with XLA', default="False")
+    parser.add_argument('--repeats', help='calls per measurement', default=20)
+    parser.add_argument('--out', help='json file the results are written to', default="benchmark_results/inference.json")
+
+    args = parser.parse_args()
+
+    if args.model is not None:
+        vae = VAE.load(args.model)
+    else:
+        vae = VAE(
+            input_shape=[8, int(args.res), int(args.res), 1],
+            conv_filters=(64, 64, 64, 32, 16),
+            conv_kernels=([2,5,5], [2,4,4], [2,3,3], [2,3,3], [2,3,3]),
+            conv_strides=([1,2,2], [1,2,2], [2,2,2], [2,2,2], [2,1,1]),
+            latent_space_dim=int(args.latent_dim),
+            name="benchmark"
+        )
+    vae.compile_inference(jit_compile=args.xla == "True")
+
+    results = {
+        "date": datetime.datetime.now().isoformat(),
+        "model": args.model,
+        "input_shape": list(vae.input_shape),
+        "xla": args.xla == "True",
+        "calls": benchmark_inference(vae, repeats=int(args.repeats))
+    }
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for name, r in results["calls"].items():
+        print(f"{name:25s} predict: {r['predict_s']*1000:8.2f} ms   fast: {r['fast_s']*1000:8.2f} ms   speedup: {r['speedup']:6.1f}x")
+    print(f"saved as {args.out}")
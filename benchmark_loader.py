@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import subprocess
+import numpy as np
+import pandas as pd
+import skvideo.io as sk
+from dataloader import SelfmotionDataGenerator, WindowedSelfmotionDataGenerator, load_selfmotion_vids, stream_selfmotion_vids, resize_batch, finish_batch, make_selfmotion_dataset
+from create_db import CustomDataGen
+from shards import convert_to_shards, ShardedSelfmotionDataGenerator, make_shard_dataset
+from synthetic import write_synthetic_dataset
+
+
+def _git_version():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stage_latencies(paths, input_shape, grayscale, batch_size):
+    """
+    Mean latency in seconds of the individual stages of turning mp4 files into a batch: read (file bytes),
+    decode (ffmpeg to rgb) and grayscale per clip, collate, resize and normalize per batch.
+    """
+    times = {stage: [] for stage in ["read", "decode", "grayscale", "resize", "normalize", "collate"]}
+    for start in range(0, len(paths) - batch_size + 1, batch_size):
+        clips = []
+        for p in paths[start:start + batch_size]:
+            t0 = time.perf_counter()
+            with open(p, "rb") as f:
+                f.read()
+            t1 = time.perf_counter()
+            vid = sk.vread(p)[:input_shape[0]]
+            t2 = time.perf_counter()
+            if grayscale:
+                vid = np.rint(vid @ np.array([0.299, 0.587, 0.114]))[..., np.newaxis].astype(np.uint8)
+            t3 = time.perf_counter()
+            times["read"].append(t1 - t0)
+            times["decode"].append(t2 - t1)
+            times["grayscale"].append(t3 - t2)
+            clips.append(vid)
+        t0 = time.perf_counter()
+        batch = np.stack(clips)
+        t1 = time.perf_counter()
+        if batch.shape[2:4] != tuple(input_shape[1:3]):
+            batch = resize_batch(batch, [input_shape[1], input_shape[2]])
+        t2 = time.perf_counter()
+        finish_batch(batch)
+        t3 = time.perf_counter()
+        times["collate"].append(t1 - t0)
+        times["resize"].append(t2 - t1)
+        times["normalize"].append(t3 - t2)
+    return {stage: float(np.mean(t)) if t else None for stage, t in times.items()}
+
+
+def measure(batches, warmup=1):
+    """
+    Pulls batches from an iterator and returns throughput in clips/s and MB/s (size of the delivered
+    clips) after `warmup` batches.
+    """
+    clips, nbytes = 0, 0
+    start = None
+    for i, X in enumerate(batches):
+        if i == warmup:
+            start = time.perf_counter()
+        if i >= warmup:
+            clips += len(X)
+            nbytes += X.nbytes
+    if start is None or clips == 0:
+        return {"clips_per_s": None, "mb_per_s": None, "clips": 0}
+    seconds = time.perf_counter() - start
+    return {"clips_per_s": clips / seconds, "mb_per_s": nbytes / seconds / 1e6, "clips": clips, "seconds": seconds}
+
+
+def _sequence_batches(gen, num_batches):
+    for i in range(min(num_batches, len(gen))):
+        X = gen[i][0]
+        yield X if not isinstance(X, list) else X[0]
+
+
+def _dataset_batches(ds, num_batches):
+    for X, _ in ds.take(num_batches):
+        yield X.numpy()
+
+
+def benchmark_loaders(path, input_shape, batch_size, workers, num_batches, grayscale=True, work_dir="tmp/benchmark"):
+    results = {}
+    results["SelfmotionDataGenerator"] = measure(_sequence_batches(SelfmotionDataGenerator(path, batch_size, list(input_shape), grayscale=grayscale, seed=0), num_batches))
+
+    gen = SelfmotionDataGenerator(path, batch_size, list(input_shape), grayscale=grayscale, seed=0, ffmpeg_resize=True)
+    results["SelfmotionDataGenerator[ffmpeg_resize]"] = measure(_sequence_batches(gen, num_batches))
+
+    gen = SelfmotionDataGenerator(path, batch_size, list(input_shape), grayscale=grayscale, seed=0, normalize=False)
+    results["SelfmotionDataGenerator[uint8]"] = measure(_sequence_batches(gen, num_batches))
+
+    t = time.perf_counter()
+    gen = SelfmotionDataGenerator(path, batch_size, list(input_shape), grayscale=grayscale, seed=0, cache=True, cache_dir=os.path.join(work_dir, "clip_cache"))
+    build = time.perf_counter() - t
+    results["SelfmotionDataGenerator[cache]"] = dict(measure(_sequence_batches(gen, num_batches)), setup_s=build)
+
+    if workers > 0:
+        gen = SelfmotionDataGenerator(path, batch_size, list(input_shape), grayscale=grayscale, seed=0, workers=workers)
+        results[f"SelfmotionDataGenerator[workers={workers}]"] = measure(_sequence_batches(gen, num_batches))
+        gen.prefetcher.close()
+
+    ds = make_selfmotion_dataset(path, batch_size, list(input_shape), grayscale=grayscale, seed=0)
+    results["make_selfmotion_dataset"] = measure(_dataset_batches(ds, num_batches))
+
+    ds = make_selfmotion_dataset(path, batch_size, list(input_shape), grayscale=grayscale, seed=0, ffmpeg_resize=True, normalize=False)
+    results["make_selfmotion_dataset[ffmpeg_resize,uint8]"] = measure(_dataset_batches(ds, num_batches))
+
+    gen = WindowedSelfmotionDataGenerator(path, batch_size, list(input_shape), grayscale=grayscale, seed=0, windows_per_video=1, window_stride=1)
+    results["WindowedSelfmotionDataGenerator"] = measure(_sequence_batches(gen, num_batches))
+
+    t = time.perf_counter()
+    convert_to_shards(path, os.path.join(work_dir, "shards"), list(input_shape), grayscale=grayscale, shard_size=max(batch_size * 4, 1), workers=workers)
+    build = time.perf_counter() - t
+    gen = ShardedSelfmotionDataGenerator(os.path.join(work_dir, "shards"), batch_size, seed=0)
+    results["ShardedSelfmotionDataGenerator"] = dict(measure(_sequence_batches(gen, num_batches)), setup_s=build)
+    ds = make_shard_dataset(os.path.join(work_dir, "shards"), batch_size, seed=0)
+    results["make_shard_dataset"] = measure(_dataset_batches(ds, num_batches))
+
+    # CustomDataGen does not resize, it reads the frames at their stored resolution
+    data = pd.read_csv(path)
+    df = pd.DataFrame({"filepath": [os.path.join(os.path.dirname(path), f) for f in data["file_head"]]})
+    res = tuple(sk.vread(df["filepath"][0], num_frames=1).shape[1:3])
+    gen = CustomDataGen(df, batch_size, input_size=res, img_count=input_shape[0])
+    results["CustomDataGen"] = measure(_sequence_batches(gen, num_batches))
+
+    # the in-memory loader delivers everything at once, its throughput covers the whole csv, it does not resize either
+    t = time.perf_counter()
+    x_train, _, x_test, _ = load_selfmotion_vids(path, [input_shape[0], res[0], res[1]], batch_size, bw=grayscale)
+    seconds = time.perf_counter() - t
+    clips = len(x_train) + len(x_test)
+    results["load_selfmotion_vids"] = {"clips_per_s": clips / seconds, "mb_per_s": (x_train.nbytes + x_test.nbytes) / seconds / 1e6, "clips": clips, "seconds": seconds}
+
+    train, _ = stream_selfmotion_vids(path, input_shape, chunk_size=batch_size, bw=grayscale, workers=workers)
+    results["stream_selfmotion_vids"] = measure(x for x, _ in train)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Data loader throughput benchmark')
+
+    parser.add_argument('--dataset', help='optional, csv of an existing dataset, a synthetic one is generated otherwise', default=None)
+    parser.add_argument('--clips', help='number of synthetic clips', default=64)
+    parser.add_argument('--source-res', help='resolution of the synthetic clips', default=512)
+    parser.add_argument('--res', help='resolution the loaders deliver (res x res)', default=256)
+    parser.add_argument('--frames', help='frames per clip', default=8)
+    parser.add_argument('--batch-size', help='batch size', default=8)
+    parser.add_argument('--batches', help='number of batches per loader', default=6)
+    parser.add_argument('--workers', help='number of decoding processes', default=4)
+    parser.add_argument('--out', help='json file the results are written to', default="benchmark_results/loader.json")
+    parser.add_argument('--work-dir', help='folder for synthetic data, caches and shards', default="tmp/benchmark")
+
+    args = parser.parse_args()
+
+    input_shape = [int(args.frames), int(args.res), int(args.res)]
+    batch_size = int(args.batch_size)
+    workers = int(args.workers)
+
+    path = args.dataset
+    if path is None:
+        path = write_synthetic_dataset(os.path.join(args.work_dir, "synthetic"), n=int(args.clips), frames=int(args.frames), res=int(args.source_res))
+
+    files = [os.path.join(os.path.dirname(path), f) for f in pd.read_csv(path)["file_head"]]
+
+    results = {
+        "version": _git_version(),
+        "date": datetime.datetime.now().isoformat(),
+        "dataset": path,
+        "input_shape": input_shape,
+        "batch_size": batch_size,
+        "workers": workers,
+        "stage_latency_s": stage_latencies(files[:batch_size * int(args.batches)], input_shape, True, batch_size),
+        "loaders": benchmark_loaders(path, input_shape, batch_size, workers, int(args.batches), work_dir=args.work_dir)
+    }
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for name, r in results["loaders"].items():
+        print(f"{name:45s} {r['clips_per_s'] or 0:10.1f} clips/s {r['mb_per_s'] or 0:10.1f} MB/s")
+    print(f"saved as {args.out}")
@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import resource
+import subprocess
+import numpy as np
+import tensorflow as tf
+from sm_vae import VAE
+
+
+def _peak_memory_mb():
+    # device peak of the first GPU if there is one, peak resident set size of this process otherwise
+    if tf.config.list_physical_devices("GPU"):
+        return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 1e6
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def run_config(res, batch_size, steps, latent_dim=180, recompute_blocks=None, accumulation_steps=None, precision="float32"):
+    """
+    Trains the train.py architecture on random clips for `steps` batches and returns the mean step time
+    after the first (tracing) step, the peak memory and the last loss.
+    """
+    vae = VAE(
+        input_shape=[8, res, res, 1],
+        conv_filters=(64, 64, 64, 32, 16),
+        conv_kernels=([2,5,5], [2,4,4], [2,3,3], [2,3,3], [2,3,3]),
+        conv_strides=([1,2,2], [1,2,2], [2,2,2], [2,2,2], [2,1,1]),
+        latent_space_dim=latent_dim,
+        name="benchmark",
+        recompute_blocks=recompute_blocks,
+        precision=precision
+    )
+    vae.compile(accumulation_steps=accumulation_steps)
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 1, [batch_size, 8, res, res, 1]).astype(np.float32)
+    y = rng.uniform(0, 1, [batch_size, 6]).astype(np.float32)
+
+    vae.model.train_on_batch(x, [x, y])
+    start = time.perf_counter()
+    for _ in range(steps):
+        logs = vae.model.train_on_batch(x, [x, y], return_dict=True)
+    step = (time.perf_counter() - start) / steps
+    return {"step_s": step, "peak_memory_mb": _peak_memory_mb(), "loss": float(logs["loss"])}
+
+
+def run_isolated(config):
+    # every configuration runs in its own process, peak memory is a high water mark of the process
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--config", json.dumps(config)], capture_output=True, text=True)
+    if out.returncode != 0:
+        return {"error": out.stderr.strip().splitlines()[-1] if out.stderr.strip() else f"exit code {out.returncode}"}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Training step benchmark: step time and peak memory per configuration')
+
+    parser.add_argument('--res', help='resolution of frames (res x res)', default=128)
+    parser.add_argument('--batch-size', help='batch size', default=4)
+    parser.add_argument('--steps', help='measured train steps per configuration', default=5)
+    parser.add_argument('--recompute-blocks', help='comma separated conv layers recomputed in the compared configuration, or all', default="all")
+    parser.add_argument('--precisions', help='comma separated precisions compared against float32 (see VAE)', default="mixed_bfloat16")
+    parser.add_argument('--out', help='json file the results are written to', default="benchmark_results/training.json")
+    parser.add_argument('--config', help=argparse.SUPPRESS, default=None)
+
+    args = parser.parse_args()
+
+    if args.config is not None:
+        print(json.dumps(run_config(**json.loads(args.config))))
+        sys.exit()
+
+    base = {"res": int(args.res), "batch_size": int(args.batch_size), "steps": int(args.steps)}
+    recompute = "all" if args.recompute_blocks == "all" else args.recompute_blocks.split(",")
+    configs = {
+        "baseline": base,
+        f"recompute[{args.recompute_blocks}]": dict(base, recompute_blocks=recompute),
+    }
+    for precision in args.precisions.split(","):
+        configs[f"precision[{precision}]"] = dict(base, precision=precision)
+
+    results = {
+        "date": datetime.datetime.now().isoformat(),
+        "device": "GPU" if tf.config.list_physical_devices("GPU") else "CPU",
+        "configs": {name: dict(config=config, **run_isolated(config)) for name, config in configs.items()}
+    }
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for name, r in results["configs"].items():
+        if "error" in r:
+            print(f"{name:35s} failed: {r['error']}")
+        else:
+            print(f"{name:35s} step: {r['step_s']*1000:9.1f} ms   peak memory: {r['peak_memory_mb']:9.1f} MB   loss: {r['loss']:.4f}")
+    print(f"saved as {args.out}")
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import random
+import shutil
+import threading
+import numpy as np
+import tensorflow as tf
+from distributed import write_folder, remove_write_folder
+
+# Checkpoint folder layout (one folder per run):
+#   ckpt-<epoch>-<batch>/    weights.npz (model.get_weights()), optimizer.npz (optimizer variables),
+#                            state.json (epoch, batch, batch size, loss, rng and loader state), parameters.pkl
+#   index.json               checkpoints in the order they were written, the best one and its loss
+# A checkpoint at (epoch, batch) continues with batch `batch` of epoch `epoch`.
+
+
+def optimizer_variables(optimizer, trainable_variables=None):
+    # the slot variables only exist after the first update, building them allows restoring before training
+    if trainable_variables is not None:
+        inner = optimizer.inner_optimizer if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer) else optimizer
+        if hasattr(inner, "_create_all_weights"):
+            # optimizer_v2 (TF < 2.11)
+            inner._create_all_weights(trainable_variables)
+        else:
+            inner.build(trainable_variables)
+    variables = optimizer.variables() if callable(optimizer.variables) else optimizer.variables
+    return list(variables)
+
+
+def _rng_state():
+    np_state = np.random.get_state()
+    return {
+        "numpy": [np_state[0], np_state[1].tolist(), int(np_state[2]), int(np_state[3]), float(np_state[4])],
+        "python": json.loads(json.dumps(random.getstate())),
+        "tensorflow": tf.random.get_global_generator().state.numpy().tolist()
+    }
+
+
+def restore_rng_state(state):
+    np_state = state["numpy"]
+    np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32), np_state[2], np_state[3], np_state[4]))
+    python_state = state["python"]
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+    tf.random.get_global_generator().reset(np.array(state["tensorflow"], dtype=np.int64))
+
+
+def checkpoint_path(folder, which="latest"):
+    # which is "latest", "best" or the name of a checkpoint folder
+    with open(os.path.join(folder, "index.json"), "r") as f:
+        index = json.load(f)
+    if which == "latest":
+        name = index["checkpoints"][-1]
+    elif which == "best":
+        name = index["best"]
+    else:
+        name = which
+    return os.path.join(folder, name)
+
+
+def load_checkpoint(folder, which="latest"):
+    """
+    Reads a checkpoint of a run folder, which is "latest", "best" or the name of a checkpoint folder.
+    Returns its path, the model weights, the optimizer variables and the state dict.
+    """
+    path = checkpoint_path(folder, which)
+    with np.load(os.path.join(path, "weights.npz")) as f:
+        weights = [f[f"arr_{i}"] for i in range(len(f.files))]
+    with np.load(os.path.join(path, "optimizer.npz")) as f:
+        optimizer = [f[f"arr_{i}"] for i in range(len(f.files))]
+    with open(os.path.join(path, "state.json"), "r") as f:
+        state = json.load(f)
+    return path, weights, optimizer, state
+
+
+class CheckpointManager(tf.keras.callbacks.Callback):
+    """
+    Snapshots weights, optimizer variables, epoch / batch, rng and loader state every `interval` batches
+    and at the end of every epoch. The snapshot is copied to host memory on the training thread and written
+    by a background thread, at most one write is in flight. Keeps the last `keep` checkpoints plus the one
+    with the lowest monitored loss (the loss of the epoch so far at the time of the snapshot).
+    Under a multi worker strategy every worker runs the callback (the snapshot is a collective), workers
+    other than the chief write to a temporary folder that is removed at the end of training.
+    """
+    def __init__(self, vae, folder, interval=1500, keep=3, monitor="loss", train_gen=None, batch_offset=0, verbosity=1, chief=True, task_id=0):
+        super().__init__()
+        self.vae = vae
+        self.chief = chief
+        self.folder = write_folder(folder, chief, task_id)
+        self.interval = interval
+        self.keep = keep
+        self.monitor = monitor
+        self.train_gen = train_gen
+        # batches of the current epoch trained before this fit call (resumed run)
+        self.batch_offset = batch_offset
+        self.verbosity = verbosity
+
+        self.epoch = 0
+        self.checkpoints, self.best, self.best_loss = [], None, np.inf
+        if os.path.exists(os.path.join(folder, "index.json")):
+            with open(os.path.join(folder, "index.json"), "r") as f:
+                index = json.load(f)
+            self.checkpoints, self.best, self.best_loss = index["checkpoints"], index["best"], index["best_loss"]
+        self._thread = None
+        self._error = None
+        # time the training thread spent on checkpoints and time of the background writes
+        self.snapshot_seconds = 0
+        self.write_seconds = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.interval and (batch + 1) % self.interval == 0:
+            self.save(self.epoch, self.batch_offset + batch + 1, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.batch_offset = 0
+        self.save(epoch + 1, 0, logs)
+
+    def on_train_end(self, logs=None):
+        self.wait()
+        remove_write_folder(self.folder, self.chief)
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, epoch, batch, logs=None):
+        start = time.perf_counter()
+        loss = float((logs or {}).get(self.monitor, np.nan))
+        loader_state = None
+        if self.train_gen is not None and hasattr(self.train_gen, "get_state"):
+            loader_state = dict(self.train_gen.get_state(), epoch=epoch, batch=batch)
+        state = {"epoch": epoch, "batch": batch, "batch_size": getattr(self.train_gen, "batch_size", None), "loss": loss, "rng": _rng_state(), "loader": loader_state, "time": time.time()}
+        weights = self.vae.model.get_weights()
+        optimizer = [v.numpy() for v in optimizer_variables(self.vae.model.optimizer)]
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(epoch, batch, weights, optimizer, state), daemon=False)
+        self._thread.start()
+        self.snapshot_seconds += time.perf_counter() - start
+
+    def _write(self, epoch, batch, weights, optimizer, state):
+        try:
+            start = time.perf_counter()
+            name = f"ckpt-{epoch:05d}-{batch:06d}"
+            path, tmp = os.path.join(self.folder, name), os.path.join(self.folder, f".{name}.tmp")
+            os.makedirs(tmp, exist_ok=True)
+            np.savez(os.path.join(tmp, "weights.npz"), *weights)
+            np.savez(os.path.join(tmp, "optimizer.npz"), *optimizer)
+            with open(os.path.join(tmp, "state.json"), "w") as f:
+                json.dump(state, f)
+            self.vae._save_parameters(tmp, "")
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(tmp, path)
+
+            if name in self.checkpoints:
+                self.checkpoints.remove(name)
+            self.checkpoints.append(name)
+            if state["loss"] < self.best_loss:
+                self.best, self.best_loss = name, state["loss"]
+            for old in self.checkpoints[:-self.keep]:
+                if old != self.best:
+                    shutil.rmtree(os.path.join(self.folder, old), ignore_errors=True)
+            self.checkpoints = [c for c in self.checkpoints[:-self.keep] if c == self.best] + self.checkpoints[-self.keep:]
+            with open(os.path.join(self.folder, ".index.json.tmp"), "w") as f:
+                json.dump({"checkpoints": self.checkpoints, "best": self.best, "best_loss": self.best_loss}, f, indent=2)
+            os.replace(os.path.join(self.folder, ".index.json.tmp"), os.path.join(self.folder, "index.json"))
+            self.write_seconds += time.perf_counter() - start
+            if self.verbosity:
+                print(f"\nsaved checkpoint {path}")
+        except Exception as e:
+            self._error = e
@@ -13,7 +13,9 @@ class CustomDataGen(tf.keras.utils.Sequence):
                  input_size=(512, 512),
                  img_count=8,
                  grayscale=False,
-                 shuffle=True):
+                 shuffle=True,
+                 start_frame=0,
+                 frame_stride=1):
         
         self.df = df.copy()
         # self.X_col = X_col
@@ -23,6 +25,9 @@ class CustomDataGen(tf.keras.utils.Sequence):
         self.img_count = img_count
         self.grayscale = grayscale
         self.shuffle = shuffle
+        # frame window read from every video: img_count frames starting at start_frame, every frame_stride-th frame
+        self.start_frame = start_frame
+        self.frame_stride = frame_stride
         
         self.n = len(self.df)
         # self.n_name = df[y_col['name']].nunique()
@@ -49,10 +54,13 @@ class CustomDataGen(tf.keras.utils.Sequence):
         reader = imageio.get_reader(path[0])
         cnt = 0
         vid = np.empty(shape=(self.img_count, target_size[0], target_size[1], 3)).astype("float32") if not self.grayscale else np.empty(shape=(self.img_count, 8, target_size[0], target_size[1])).astype("float32")
-        for img in reader:
-            if cnt < self.img_count:
-                vid[cnt,:,:,:] = np.array(img)
-                cnt += 1
+        try:
+            # only the frames of the window are requested, the ffmpeg reader seeks to far away frames
+            # instead of decoding everything before them, and nothing after the last frame is read
+            for cnt in range(self.img_count):
+                vid[cnt,:,:,:] = np.array(reader.get_data(self.start_frame + cnt * self.frame_stride))
+        finally:
+            reader.close()
 
         # image_arr = image_arr[ymin:ymin+h, xmin:xmin+w]
         # vid_arr = tf.compat.v1.Session().run(tf.image.resize(vid,(target_size[0], target_size[1])))
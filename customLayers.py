@@ -2,8 +2,8 @@ import tensorflow as tf
 from tensorflow.keras import backend as K
 
 class SampleLayer(tf.keras.layers.Layer):
-    def __init__(self, name=None):
-        super(SampleLayer, self).__init__(name=name)
+    def __init__(self, name=None, **kwargs):
+        super(SampleLayer, self).__init__(name=name, **kwargs)
     
     def call(self, inputs):
         mu, log_variance = inputs
@@ -60,4 +60,35 @@ class KL_Layer(tf.keras.layers.Layer):
         self.add_loss(kl_mean_batch, inputs=inputs)
         # We add the loss information to the metrics displayed during training 
         self.add_metric(kl_mean_batch, name='kl_loss', aggregation='mean')
-        return inputs
\ No newline at end of file
+        return inputs
+
+class RecomputeBlock(tf.keras.layers.Layer):
+    '''
+    @note: Applies `block_layers` in sequence and recomputes their activations in the backward pass
+           (tf.recompute_grad), only the block input is kept for backprop. The wrapped layers must not
+           update state in the forward pass (no batch norm). The weights stay in the same order as
+           without the wrapper, so weights are interchangeable between both variants.
+    '''
+    def __init__(self, block_layers, *args, **kwargs):
+        super(RecomputeBlock, self).__init__(*args, **kwargs)
+        self.block_layers = block_layers
+
+    def build(self, input_shape):
+        shape = tf.TensorShape(input_shape)
+        for layer in self.block_layers:
+            layer.build(shape)
+            shape = layer.compute_output_shape(shape)
+        super(RecomputeBlock, self).build(input_shape)
+
+    def compute_output_shape(self, input_shape):
+        shape = tf.TensorShape(input_shape)
+        for layer in self.block_layers:
+            shape = layer.compute_output_shape(shape)
+        return shape
+
+    def call(self, inputs):
+        def block(x):
+            for layer in self.block_layers:
+                x = layer(x)
+            return x
+        return tf.recompute_grad(block)(inputs)
@@ -12,6 +12,13 @@ import matplotlib.pyplot as plt
 import tensorflow as tf
 import tensorflow.keras as keras
 import time
+import json
+import hashlib
+import functools
+from collections import OrderedDict
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
 
 def shuffle_along_axis(a, axis):
     idx = np.random.rand(*a.shape).argsort(axis=axis)
@@ -65,8 +72,380 @@ def load_selfmotion_vids(path, video_dim, batch_size=32, train_split=0.8, bw=Tru
     return x_train, y_train, x_test, y_test
 
 
+def _selfmotion_split(n, train_split, randomize):
+    # reproduces the sample order of load_selfmotion_vids: the video in csv row i ends up at position idx[i]
+    idx = np.arange(n)
+    if randomize:
+        np.random.shuffle(idx)
+    order = np.argsort(idx)
+    split_idx = int(n * train_split)
+    return order[:split_idx], order[split_idx:]
+
+
+def _stream_chunks(paths, labels, rows, video_dim, bw, chunk_size, workers, normalize, decode_options={}):
+    read = functools.partial(read_clip, input_shape=video_dim, grayscale=bw, **decode_options)
+    pool = mp.get_context("spawn").Pool(workers) if workers > 0 else None
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            chunk_paths = [paths[r] for r in chunk]
+            clips = pool.map(read, chunk_paths) if pool is not None else [read(p) for p in chunk_paths]
+            yield finish_batch(np.stack(clips), normalize), labels[chunk]
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def stream_selfmotion_vids(path, video_dim, chunk_size=256, train_split=0.8, bw=True, randomize=True, workers=4, out_dir=None, normalize=True):
+    """
+    Streaming variant of load_selfmotion_vids that never holds more than chunk_size clips in memory.
+    Train/test membership and order follow load_selfmotion_vids for the same numpy seed, clips are decoded
+    by `workers` processes. Returns (train, test) generators yielding (x_chunk, y_chunk), or, if out_dir is
+    given, writes x_train/y_train/x_test/y_test.npy there chunk by chunk and returns them memory-mapped.
+    With normalize=False clips stay uint8 (see finish_batch).
+    """
+    print("loading Dataset...")
+
+    base_path = os.path.dirname(path)
+    data = pd.read_csv(f"{path}", sep=",")
+    paths = [os.path.join(base_path, f) for f in data["file_head"]]
+    labels = data.loc[:, "velX": "roll"].to_numpy()
+    video_dim = list(video_dim[:3])
+
+    train_rows, test_rows = _selfmotion_split(data.shape[0], train_split, randomize)
+    train = _stream_chunks(paths, labels, train_rows, video_dim, bw, chunk_size, workers, normalize)
+    test = _stream_chunks(paths, labels, test_rows, video_dim, bw, chunk_size, workers, normalize)
+    if out_dir is None:
+        return train, test
+
+    os.makedirs(out_dir, exist_ok=True)
+    out = []
+    for split, rows, chunks in (("train", train_rows, train), ("test", test_rows, test)):
+        x_path = os.path.join(out_dir, f"x_{split}.npy")
+        y_path = os.path.join(out_dir, f"y_{split}.npy")
+        x = np.lib.format.open_memmap(x_path, mode="w+", dtype=np.float32 if normalize else np.uint8, shape=(len(rows), *video_dim, 1 if bw else 3))
+        y = np.lib.format.open_memmap(y_path, mode="w+", dtype=labels.dtype, shape=(len(rows), labels.shape[1]))
+        pos = 0
+        for x_chunk, y_chunk in tqdm(chunks, total=-(-len(rows) // chunk_size), desc=split):
+            x[pos:pos + len(x_chunk)] = x_chunk
+            y[pos:pos + len(y_chunk)] = y_chunk
+            pos += len(x_chunk)
+        x.flush()
+        y.flush()
+        del x, y
+        out += [np.load(x_path, mmap_mode="r"), np.load(y_path, mmap_mode="r")]
+    return tuple(out)
+
+
+def finish_batch(x, normalize=True):
+    """
+    Turns decoded clips with values in 0..255 (uint8, or float after resizing) into a batch. With normalize
+    they are scaled to float32 in [0, 1], otherwise they stay uint8 and are normalized inside the model
+    (VAE(normalize_input=True)), which keeps batches and queues at a quarter of the size.
+    """
+    if normalize:
+        return x.astype(np.float32)/255.
+    return x if x.dtype == np.uint8 else np.clip(np.rint(x), 0, 255).astype(np.uint8)
+
+
+# ffmpeg scaler flags matching the interpolation methods of tf.image.resize
+FFMPEG_SCALE_FLAGS = {
+    "bilinear": "bilinear",
+    "bicubic": "bicubic",
+    "area": "area",
+    "nearest": "neighbor",
+    "lanczos3": "lanczos",
+    "lanczos5": "lanczos",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _frame_rate(path):
+    num, den = sk.ffprobe(path)["video"]["@avg_frame_rate"].split("/")
+    return float(num) / float(den)
+
+
+def decode_clip(path, input_shape, grayscale=True, method="bilinear", ffmpeg_resize=False, start=0, stride=1):
+    """
+    Decodes input_shape[0] frames as uint8 T x H x W x C, beginning at frame `start` and taking every
+    `stride`-th frame. ffmpeg seeks to `start` on the input (decoding from the preceding keyframe, constant
+    frame rate assumed), drops the frames between the strided ones and is stopped as soon as the window
+    has been read, so long source videos only cost about the frames actually used. With ffmpeg_resize the
+    frames are scaled by ffmpeg and never reach python at full resolution.
+    """
+    count = input_shape[0]
+    filters = []
+    inputdict = {}
+    if start > 0:
+        # half a frame early, ffmpeg starts at the first frame at or after the seek point
+        inputdict["-ss"] = f"{(start - 0.5) / _frame_rate(path):.6f}"
+    if stride > 1:
+        filters.append(f"select=not(mod(n\\,{stride}))")
+    outputdict = {"-vframes": str(count), "-vsync": "0"}
+    if ffmpeg_resize:
+        height, width = input_shape[1], input_shape[2]
+        filters.append(f"scale={width}:{height}:flags={FFMPEG_SCALE_FLAGS[method]}")
+        outputdict["-s"] = f"{width}x{height}"
+    if filters:
+        outputdict["-vf"] = ",".join(filters)
+    if grayscale:
+        outputdict["-pix_fmt"] = "gray"
+
+    reader = sk.FFmpegReader(path, inputdict=inputdict, outputdict=outputdict)
+    try:
+        frames = [frame for _, frame in zip(range(count), reader.nextFrame())]
+    finally:
+        reader.close()
+    if len(frames) < count:
+        raise ValueError(f"{path} has only {len(frames)} frames in the window (start={start}, stride={stride}), {count} are required")
+    return np.stack(frames)
+
+
+def resize_batch(batch, size, method="bilinear", antialias=True):
+    """
+    Resizes a B x T x H x W x C batch of clips to size (height, width) with a single tf.image.resize call
+    over all B*T frames. Returns a float32 array in the value range of the input.
+    """
+    b, t = batch.shape[0], batch.shape[1]
+    frames = tf.reshape(batch, (b * t,) + tuple(batch.shape[2:]))
+    frames = tf.image.resize(frames, size, method=method, antialias=antialias)
+    return tf.reshape(frames, (b, t, size[0], size[1], batch.shape[-1])).numpy()
+
+
+def read_clip(path, input_shape, grayscale=True, method="bilinear", antialias=True, ffmpeg_resize=False, start=0, stride=1):
+    # decodes a video into a uint8 array of shape T x H x W x C that matches input_shape
+    vid = decode_clip(path, input_shape, grayscale, method=method, ffmpeg_resize=ffmpeg_resize, start=start, stride=stride)
+    if vid.shape[1:3] != tuple(input_shape[1:3]):
+        vid = resize_batch(vid[np.newaxis], [input_shape[1], input_shape[2]], method=method, antialias=antialias)[0]
+        vid = np.clip(np.rint(vid), 0, 255)
+    return vid.astype(np.uint8)
+
+
+def _clip_cache_key(path, input_shape, grayscale, decode_options):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        h.update(f.read())
+    h.update(json.dumps([list(map(int, input_shape[:3])), bool(grayscale), decode_options], sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def materialize_clip_cache(path, input_shape, grayscale=True, cache_dir="tmp/clip_cache", force=False, decode_options={}):
+    """
+    Decodes, converts and resizes all clips listed in the CSV once and stores them as a memory-mappable
+    uint8 array (clips.npy, N x T x H x W x C) next to the raw labels (labels.npy, N x 6).
+    The cache is rebuilt whenever the CSV content, input_shape, grayscale flag or decode_options (keyword
+    arguments of read_clip: resize method, frame window) change.
+    Returns the folder containing the cache.
+    """
+    base_path = os.path.dirname(path)
+    folder = os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0])
+    meta_path = os.path.join(folder, "meta.json")
+    key = _clip_cache_key(path, input_shape, grayscale, decode_options)
+
+    if not force and os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            if json.load(f).get("key") == key:
+                return folder
+
+    print(f"materializing clip cache in {folder}...")
+    os.makedirs(folder, exist_ok=True)
+    data = pd.read_csv(f"{path}", sep=",")
+    n = data.shape[0]
+    shape = (n, input_shape[0], input_shape[1], input_shape[2], 1 if grayscale else 3)
+
+    # write to temporary files first so an interrupted run never leaves a valid looking cache behind
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    clips = np.lib.format.open_memmap(os.path.join(folder, "clips.tmp.npy"), mode="w+", dtype=np.uint8, shape=shape)
+    for i in tqdm(np.arange(n)):
+        clips[i] = read_clip(os.path.join(base_path, data["file_head"][i]), input_shape, grayscale, **decode_options)
+    clips.flush()
+    del clips
+    np.save(os.path.join(folder, "labels.tmp.npy"), data.loc[:, "velX": "roll"].to_numpy(dtype=np.float32))
+
+    os.replace(os.path.join(folder, "clips.tmp.npy"), os.path.join(folder, "clips.npy"))
+    os.replace(os.path.join(folder, "labels.tmp.npy"), os.path.join(folder, "labels.npy"))
+    with open(meta_path, "w") as f:
+        json.dump({"key": key, "csv": os.path.abspath(path), "shape": list(shape), "grayscale": bool(grayscale)}, f)
+    return folder
+
+
+def make_selfmotion_dataset(path, batch_size, input_shape=[8, 512, 512], grayscale=True, shuffle=True, seed=None, deterministic=True, resize_method="bilinear", antialias=True, ffmpeg_resize=False, start_frame=0, frame_stride=1, normalize=True, num_shards=1, shard_index=0):
+    """
+    Builds a tf.data pipeline over the same CSV as SelfmotionDataGenerator. Videos are decoded in parallel,
+    resized and normalized in-graph and batched as (X, (X, y)) to match VAE.model. With normalize=False
+    clips stay uint8 and are normalized by the model (VAE(normalize_input=True)). num_shards / shard_index
+    restrict it to every num_shards-th csv row (one shard per training worker).
+    """
+    base_path = os.path.dirname(path)
+    data = pd.read_csv(f"{path}", sep=",")
+    paths = [os.path.join(base_path, f) for f in data["file_head"]]
+    labels = (data.loc[:, "velX": "roll"].to_numpy() / np.array([1, 1, 1, 180, 180, 180])).astype(np.float32)
+
+    frames, height, width = input_shape[0], input_shape[1], input_shape[2]
+    channels = 1 if grayscale else 3
+
+    def decode(file):
+        # ffmpeg decodes in its own process, so parallel map calls overlap despite the GIL
+        return decode_clip(file.decode(), input_shape, grayscale, method=resize_method, ffmpeg_resize=ffmpeg_resize, start=start_frame, stride=frame_stride)
+
+    def load(file, y):
+        vid = tf.numpy_function(decode, [file], tf.uint8, stateful=False)
+        vid.set_shape([frames, None, None, channels])
+        vid = tf.cond(
+            tf.reduce_all(tf.shape(vid)[1:3] == [height, width]),
+            lambda: tf.cast(vid, tf.float32),
+            lambda: tf.image.resize(vid, [height, width], method=resize_method, antialias=antialias)
+        )
+        vid = vid / 255. if normalize else tf.cast(tf.clip_by_value(tf.round(vid), 0, 255), tf.uint8)
+        vid = tf.ensure_shape(vid, [frames, height, width, channels])
+        return vid, y
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels)).shard(num_shards, shard_index)
+    if shuffle:
+        ds = ds.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.map(load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=deterministic)
+    ds = ds.batch(batch_size, drop_remainder=True)
+    ds = ds.map(lambda x, y: (x, (x, y)), num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def load_resident_clips(path, input_shape, grayscale=True, samples=None, seed=0, mmap=False, cache_dir="tmp/clip_cache", workers=4, decode_options={}):
+    """
+    Decodes the clips of a CSV once and keeps them as uint8, either in RAM or memory-mapped from the clip
+    cache (mmap=True, see materialize_clip_cache). With `samples` only a fixed random subsample of that
+    many clips is used. Returns (clips, labels, rows), clips[rows[i]] belongs to labels[i].
+    """
+    data = pd.read_csv(f"{path}", sep=",")
+    n = data.shape[0]
+    rows = np.arange(n)
+    if samples is not None and samples < n:
+        rows = np.sort(np.random.default_rng(seed).choice(n, samples, replace=False))
+    all_labels = data.loc[:, "velX": "roll"].to_numpy() / np.array([1, 1, 1, 180, 180, 180])
+    labels = all_labels[rows]
+
+    if mmap:
+        folder = materialize_clip_cache(path, input_shape, grayscale=grayscale, cache_dir=cache_dir, decode_options=decode_options)
+        return np.load(os.path.join(folder, "clips.npy"), mmap_mode="r"), labels, rows
+
+    print("loading resident clips...")
+    base_path = os.path.dirname(path)
+    paths = [os.path.join(base_path, f) for f in data["file_head"]]
+    clips = np.empty((len(rows), input_shape[0], input_shape[1], input_shape[2], 1 if grayscale else 3), dtype=np.uint8)
+    pos = 0
+    for chunk, _ in _stream_chunks(paths, all_labels, rows, list(input_shape[:3]), grayscale, 256, workers, False, decode_options):
+        clips[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+    return clips, labels, np.arange(len(rows))
+
+
+class ResidentClipSequence(tf.keras.utils.Sequence):
+    # serves (X, [X, y]) batches from already decoded uint8 clips, e.g. a validation set (see load_resident_clips)
+    def __init__(self, clips, labels, rows, batch_size, normalize=True, path=None):
+        self.clips = clips
+        self.labels = labels
+        self.rows = rows
+        self.batch_size = batch_size
+        self.normalize = normalize
+        self.path = path
+
+    def __getitem__(self, index):
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        X = finish_batch(np.asarray(self.clips[self.rows[batch]]), self.normalize)
+        return X, [X, self.labels[batch]]
+
+    def __len__(self):
+        return -(-len(self.rows) // self.batch_size)
+
+
+def _decode_batch_into(shm_name, shape, paths, input_shape, grayscale, decode_options):
+    # runs inside a prefetch worker, writes the decoded batch straight into the shared memory slot
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        for i, p in enumerate(paths):
+            out[i] = read_clip(p, input_shape, grayscale, **decode_options)
+    finally:
+        shm.close()
+
+
+class BatchPrefetcher:
+    """
+    Decodes upcoming batches in a pool of worker processes into shared memory buffers while the
+    current batch trains. At most `depth` batches are in flight, batches are always delivered in
+    the order they are requested.
+    """
+    def __init__(self, batch_paths, num_batches, batch_shape, input_shape, grayscale, workers=4, depth=4, decode_options={}):
+        self.batch_paths = batch_paths
+        self.num_batches = num_batches
+        self.batch_shape = tuple(batch_shape)
+        self.input_shape = input_shape
+        self.grayscale = grayscale
+        self.decode_options = decode_options
+        self.depth = depth
+
+        # spawn instead of fork, forking a process that already initialized tensorflow can deadlock
+        self._pool = mp.get_context("spawn").Pool(workers)
+        nbytes = int(np.prod(self.batch_shape))
+        self._slots = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(depth)]
+        self._free = list(range(depth))
+        self._pending = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _submit(self, index):
+        slot = self._free.pop()
+        result = self._pool.apply_async(_decode_batch_into, (self._slots[slot].name, self.batch_shape, self.batch_paths(index), self.input_shape, self.grayscale, self.decode_options))
+        self._pending[index] = (result, slot)
+
+    def _fill(self):
+        while self._free and self._next < self.num_batches:
+            if self._next not in self._pending:
+                self._submit(self._next)
+            self._next += 1
+
+    def _drain(self):
+        for result, slot in self._pending.values():
+            result.wait()
+            self._free.append(slot)
+        self._pending = {}
+
+    def reset(self, start=0):
+        # drops all batches in flight, e.g. after the sample order changed at the end of an epoch
+        with self._lock:
+            self._drain()
+            self._next = start
+
+    def get(self, index):
+        with self._lock:
+            if index not in self._pending:
+                # out of order request, restart the read-ahead window at the requested batch
+                self._drain()
+                self._next = index
+            self._fill()
+            result, slot = self._pending.pop(index)
+            result.get()
+            out = np.ndarray(self.batch_shape, dtype=np.uint8, buffer=self._slots[slot].buf).copy()
+            self._free.append(slot)
+            self._fill()
+        return out
+
+    def close(self):
+        if self._pool is None:
+            return
+        self._drain()
+        self._pool.terminate()
+        self._pool = None
+        for shm in self._slots:
+            shm.close()
+            shm.unlink()
+
+    def __del__(self):
+        self.close()
+
+
 class SelfmotionDataGenerator(tf.keras.utils.Sequence):
-    def __init__(self, path, batch_size, input_shape=[8, 512, 512], rescale=False, grayscale=True, shuffle=True):
+    def __init__(self, path, batch_size, input_shape=[8, 512, 512], rescale=False, grayscale=True, shuffle=True, cache=False, cache_dir="tmp/clip_cache", workers=0, prefetch=4, seed=None, resize_method="bilinear", antialias=True, ffmpeg_resize=False, start_frame=0, frame_stride=1, normalize=True, num_shards=1, shard_index=0):
         self.path = path
         self.base_path = os.path.dirname(path)
         self.data = pd.read_csv(f"{path}", sep=",")
@@ -75,38 +454,115 @@ class SelfmotionDataGenerator(tf.keras.utils.Sequence):
         self.grayscale = grayscale
         self.shuffle = shuffle
         self.rescale = rescale
+        # normalize=False yields uint8 batches for models built with normalize_input=True
+        self.normalize = normalize
 
         self.n = self.data.shape[0]
-
-    def __get_input(self, batch):
-        out = np.empty([batch.shape[0], self.input_shape[0], self.input_shape[1], self.input_shape[2], 3], dtype=np.float32) if not self.grayscale \
-              else np.empty([batch.shape[0], self.input_shape[0], self.input_shape[1], self.input_shape[2], 1], dtype=np.float32)
-
-        for i in np.arange(batch.shape[0]):
-            vid = sk.vread(os.path.join(self.base_path, batch["file_head"][i])).squeeze().astype("float32")/255. if not self.grayscale \
-                     else sk.vread(os.path.join(self.base_path, batch["file_head"][i]), as_grey=True).astype("float32")/255.
-            if vid.shape[:-1] != tuple(self.input_shape):
-                # print("Input shape does not match video dimensions. Rescaling input to match input shape!")
-                for n in np.arange(vid.shape[0]):
-                    
-                    out[i,n] = tf.image.resize(vid[n], [self.input_shape[1], self.input_shape[2]], antialias=True)
-                continue
-            out[i] = vid
-        return out
-
-    def __get_output(self, batch):
-        return batch.loc[:,"velX": "roll"].to_numpy() / np.array([1, 1, 1, 180, 180, 180])
+        # with num_shards > 1 (one shard per training worker) only every num_shards-th csv row is used
+        self.rows = np.arange(self.n)[shard_index::num_shards]
+
+        # the csv is parsed once into contiguous arrays, batches are assembled by indexing them with a permutation
+        self.paths = np.array([os.path.join(self.base_path, f) for f in self.data["file_head"]])
+        self.labels = self.data.loc[:, "velX": "roll"].to_numpy() / np.array([1, 1, 1, 180, 180, 180])
+
+        # how clips are decoded: the frame window (start_frame, every frame_stride-th frame) and how frames that
+        # do not match input_shape are resized, with ffmpeg_resize ffmpeg scales while decoding
+        self.decode_options = {"method": resize_method, "antialias": antialias, "ffmpeg_resize": ffmpeg_resize, "start": start_frame, "stride": frame_stride}
+
+        # cache-backed mode: batches are sliced from a pre-decoded memory map instead of decoding the mp4s
+        self.cache = cache
+        self.clips = None
+        if self.cache:
+            folder = materialize_clip_cache(path, self.input_shape, grayscale=self.grayscale, cache_dir=cache_dir, decode_options=self.decode_options)
+            self.clips = np.load(os.path.join(folder, "clips.npy"), mmap_mode="r")
+
+        # the sample order of every epoch is a permutation derived from (seed, epoch), so the batch order is
+        # reproducible, also with prefetch workers, and a run can be resumed from any (epoch, batch)
+        self.seed = int(np.random.randint(2**31)) if seed is None else seed
+        self.epoch = 0
+        self._offset = 0
+        self._num_batches = len(self.rows) // self.batch_size
+        self.order = self._permutation(self.epoch)
+
+        # prefetch mode: a pool of worker processes decodes the next batches while the current one trains
+        self.workers = 0 if self.cache else workers
+        self.prefetcher = None
+        if self.workers > 0:
+            self.prefetcher = BatchPrefetcher(
+                self._batch_paths,
+                self._num_batches,
+                [self.batch_size] + list(self.input_shape[:3]) + [1 if self.grayscale else 3],
+                list(self.input_shape[:3]),
+                self.grayscale,
+                workers=self.workers,
+                depth=prefetch,
+                decode_options=self.decode_options
+            )
+
+    def _permutation(self, epoch):
+        if not self.shuffle:
+            return self.rows
+        return self.rows[np.random.default_rng([self.seed, epoch]).permutation(len(self.rows))]
+
+    def _batch_indices(self, index):
+        # index is the absolute batch number within the epoch
+        return self.order[index * self.batch_size:(index + 1) * self.batch_size]
+
+    def _batch_paths(self, index):
+        return list(self.paths[self._batch_indices(index)])
+
+    def __get_input(self, indices):
+        if self.cache:
+            # sorted reads keep the access pattern on the memory map sequential
+            order = np.argsort(indices)
+            out = np.empty((indices.size,) + self.clips.shape[1:], dtype=np.uint8)
+            out[order] = self.clips[indices[order]]
+            return finish_batch(out, self.normalize)
+
+        height, width = self.input_shape[1], self.input_shape[2]
+        opts = self.decode_options
+        vids = [decode_clip(p, self.input_shape, self.grayscale, method=opts["method"], ffmpeg_resize=opts["ffmpeg_resize"], start=opts["start"], stride=opts["stride"])
+                for p in self.paths[indices]]
+
+        if len(set(vid.shape for vid in vids)) == 1:
+            out = np.stack(vids)
+            if out.shape[2:4] != (height, width):
+                # one resize call for all B x T frames of the batch
+                out = resize_batch(out, [height, width], method=self.decode_options["method"], antialias=self.decode_options["antialias"])
+            return finish_batch(out, self.normalize)
+
+        # clips of different sizes within one batch are resized one by one
+        out = np.empty([len(vids), self.input_shape[0], height, width, 1 if self.grayscale else 3], dtype=np.float32)
+        for i, vid in enumerate(vids):
+            out[i] = vid if vid.shape[1:3] == (height, width) else \
+                     resize_batch(vid[np.newaxis], [height, width], method=self.decode_options["method"], antialias=self.decode_options["antialias"])[0]
+        return finish_batch(out, self.normalize)
+
+    def __get_output(self, indices):
+        return self.labels[indices]
 
     def __get_data(self, indices):
-        batch = self.data.iloc[indices].reset_index(drop=True)
-        X = self.__get_input(batch)
-        y = self.__get_output(batch)
+        X = self.__get_input(indices)
+        y = self.__get_output(indices)
         return X, y
 
     def on_epoch_end(self):
-        if self.shuffle:
-            self.data = self.data.sample(frac=1).reset_index(drop=True)
-    
+        self.set_position(self.epoch + 1)
+
+    def set_position(self, epoch, batch=0):
+        """
+        Continues at batch `batch` of epoch `epoch`, e.g. to resume an interrupted run. The epoch is
+        shortened by the batches that were already trained, later epochs have the full length again.
+        """
+        self.epoch = epoch
+        self._offset = batch
+        self.order = self._permutation(epoch)
+        if self.prefetcher is not None:
+            self.prefetcher.reset(batch)
+
+    def get_state(self):
+        return {"seed": self.seed, "epoch": self.epoch, "batch": self._offset}
+
     def get_input_shape(self):
         input_shape = self.input_shape
         if self.grayscale:
@@ -114,10 +570,88 @@ class SelfmotionDataGenerator(tf.keras.utils.Sequence):
         return input_shape
 
     def __getitem__(self, index):
-        indices = np.arange(index * self.batch_size, (index + 1) * self.batch_size)
+        index += self._offset
+        indices = self._batch_indices(index)
+        if self.prefetcher is not None:
+            X = finish_batch(self.prefetcher.get(index), self.normalize)
+            y = self.__get_output(indices)
+            return X, [X, y]
         X, y = self.__get_data(indices)        
         return X, [X, y]
     
+    def __len__(self):
+        return self._num_batches - self._offset
+
+
+class WindowedSelfmotionDataGenerator(tf.keras.utils.Sequence):
+    """
+    Samples windows_per_video T-frame clips from every video of the CSV, window w starts at frame
+    start_frame + w * window_stride. Each video is decoded once into an LRU of cache_videos decoded videos
+    and all of its windows are cut from there, every window carries the labels of its video.
+    With shuffle the videos are shuffled and then the windows within each group of cache_videos videos,
+    so every video is decoded only once per epoch.
+    """
+    def __init__(self, path, batch_size, input_shape=[8, 512, 512], grayscale=True, shuffle=True, windows_per_video=4, window_stride=8, frame_stride=1, start_frame=0, cache_videos=32, seed=None, resize_method="bilinear", antialias=True, ffmpeg_resize=False, normalize=True):
+        self.path = path
+        self.base_path = os.path.dirname(path)
+        self.data = pd.read_csv(f"{path}", sep=",")
+        self.batch_size = batch_size
+        self.input_shape = input_shape
+        self.grayscale = grayscale
+        self.shuffle = shuffle
+        self.normalize = normalize
+        self.windows_per_video = windows_per_video
+        self.window_stride = window_stride
+        self.frame_stride = frame_stride
+        self.cache_videos = max(cache_videos, 1)
+
+        self.paths = [os.path.join(self.base_path, f) for f in self.data["file_head"]]
+        self.labels = self.data.loc[:, "velX": "roll"].to_numpy() / np.array([1, 1, 1, 180, 180, 180])
+        self.n = len(self.paths) * windows_per_video
+
+        # frames needed to cut all windows of one video
+        self.span = (windows_per_video - 1) * window_stride + (input_shape[0] - 1) * frame_stride + 1
+        self.decode_options = {"method": resize_method, "antialias": antialias, "ffmpeg_resize": ffmpeg_resize, "start": start_frame, "stride": 1}
+        self._videos = OrderedDict()
+
+        self._random_state = np.random.RandomState(seed)
+        self.samples = np.stack(np.meshgrid(np.arange(len(self.paths)), np.arange(windows_per_video), indexing="ij"), axis=-1).reshape(-1, 2)
+        self.on_epoch_end()
+
+    def _video(self, row):
+        if row in self._videos:
+            self._videos.move_to_end(row)
+            return self._videos[row]
+        frames = read_clip(self.paths[row], [self.span, self.input_shape[1], self.input_shape[2]], self.grayscale, **self.decode_options)
+        self._videos[row] = frames
+        if len(self._videos) > self.cache_videos:
+            self._videos.popitem(last=False)
+        return frames
+
+    def on_epoch_end(self):
+        if not self.shuffle:
+            return
+        rows = self._random_state.permutation(len(self.paths))
+        samples = []
+        for start in range(0, len(rows), self.cache_videos):
+            group = rows[start:start + self.cache_videos]
+            windows = np.stack(np.meshgrid(group, np.arange(self.windows_per_video), indexing="ij"), axis=-1).reshape(-1, 2)
+            samples.append(windows[self._random_state.permutation(len(windows))])
+        self.samples = np.concatenate(samples)
+
+    def get_input_shape(self):
+        return list(self.input_shape[:3]) + [1 if self.grayscale else 3]
+
+    def __getitem__(self, index):
+        batch = self.samples[index * self.batch_size:(index + 1) * self.batch_size]
+        X = np.empty([len(batch)] + self.get_input_shape(), dtype=np.uint8)
+        for i, (row, window) in enumerate(batch):
+            first = window * self.window_stride
+            X[i] = self._video(row)[first:first + (self.input_shape[0] - 1) * self.frame_stride + 1:self.frame_stride]
+        X = finish_batch(X, self.normalize)
+        y = self.labels[batch[:, 0]]
+        return X, [X, y]
+
     def __len__(self):
         return self.n // self.batch_size
 
@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import shutil
+import socket
+import subprocess
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from dataloader import SelfmotionDataGenerator, make_selfmotion_dataset
+
+# Data parallel training on one many-core host: `python train.py --workers N ...` starts N copies of itself
+# (launch_workers), each with a TF_CONFIG for a localhost MultiWorkerMirroredStrategy cluster and pinned to
+# its own contiguous set of cores. Every worker reads its own shard of the csv (make_worker_dataset).
+
+
+def is_worker():
+    return "TF_CONFIG" in os.environ
+
+
+def write_folder(folder, chief, task_id):
+    # every worker has to save, reading the SyncOnRead batch norm statistics is a collective over all
+    # workers, but only the files of the chief are kept (see remove_write_folder)
+    return folder if chief else os.path.join(folder, f"workertemp_{task_id}")
+
+
+def remove_write_folder(folder, chief):
+    if not chief:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def _free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def worker_core_sets(num_workers, cores=None):
+    # contiguous core ranges, neighbouring cores usually share a NUMA node
+    cores = sorted(os.sched_getaffinity(0)) if cores is None else cores
+    if len(cores) < num_workers:
+        raise ValueError(f"{num_workers} workers need at least as many cores, {len(cores)} available")
+    return [set(int(c) for c in chunk) for chunk in np.array_split(cores, num_workers)]
+
+
+def launch_workers(num_workers, argv, log_dir="logs/workers"):
+    """
+    Runs `python argv` num_workers times as one localhost cluster and waits for all of them. Worker 0 (the
+    chief) prints to this terminal, the others log to log_dir/worker_<i>.log. If a worker fails the others
+    are terminated. Returns the first non zero exit code.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    workers = [f"localhost:{port}" for port in _free_ports(num_workers)]
+    procs, logs = [], []
+    for index, cores in enumerate(worker_core_sets(num_workers)):
+        env = os.environ.copy()
+        env["TF_CONFIG"] = json.dumps({"cluster": {"worker": workers}, "task": {"type": "worker", "index": index}})
+        env["OMP_NUM_THREADS"] = str(len(cores))
+        out = None
+        if index > 0:
+            logs.append(open(os.path.join(log_dir, f"worker_{index}.log"), "w"))
+            out = logs[-1]
+        procs.append(subprocess.Popen(
+            [sys.executable] + list(argv),
+            env=env,
+            stdout=out,
+            stderr=subprocess.STDOUT if out is not None else None,
+            preexec_fn=lambda cores=cores: os.sched_setaffinity(0, cores)
+        ))
+    try:
+        codes = [p.wait() for p in procs]
+    except KeyboardInterrupt:
+        codes = [1]
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+        for f in logs:
+            f.close()
+    return next((c for c in codes if c != 0), 0)
+
+
+def configure_worker():
+    """
+    Called once at the start of a worker process, before TensorFlow runs anything: sizes the thread pools
+    to the cores the launcher pinned the process to and returns the MultiWorkerMirroredStrategy.
+    """
+    cores = len(os.sched_getaffinity(0))
+    tf.config.threading.set_intra_op_parallelism_threads(cores)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    options = tf.distribute.experimental.CommunicationOptions(implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+
+def _sequence_dataset(gen):
+    # endless dataset over a SelfmotionDataGenerator, fit takes steps_per_epoch batches per epoch from it
+    x_spec = tf.TensorSpec([gen.batch_size] + list(gen.input_shape[:3]) + [1 if gen.grayscale else 3], tf.float32 if gen.normalize else tf.uint8)
+
+    def batches():
+        while True:
+            for i in range(len(gen)):
+                X, (_, y) = gen[i]
+                yield X, (X, y.astype(np.float32))
+            gen.on_epoch_end()
+
+    return tf.data.Dataset.from_generator(batches, output_signature=(x_spec, (x_spec, tf.TensorSpec([gen.batch_size, 6], tf.float32))))
+
+
+def make_worker_dataset(path, global_batch_size, input_shape, input_pipeline="sequence", shuffle=True, normalize=True, loader_workers=0):
+    """
+    Returns a DatasetCreator for model.fit under MultiWorkerMirroredStrategy and the number of steps per
+    epoch. Every worker builds its own input pipeline over its shard of the csv with the per replica batch
+    size, nothing is autosharded or rebatched.
+    """
+    rows = len(pd.read_csv(path))
+
+    def dataset_fn(input_context):
+        batch_size = input_context.get_per_replica_batch_size(global_batch_size)
+        shard = {"num_shards": input_context.num_input_pipelines, "shard_index": input_context.input_pipeline_id}
+        if input_pipeline == "tfdata":
+            ds = make_selfmotion_dataset(path, batch_size, list(input_shape), grayscale=True, shuffle=shuffle, normalize=normalize, **shard).repeat()
+        else:
+            ds = _sequence_dataset(SelfmotionDataGenerator(path, batch_size, list(input_shape), grayscale=True, shuffle=shuffle, workers=loader_workers, normalize=normalize, **shard))
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        return ds.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+    return tf.keras.utils.experimental.DatasetCreator(dataset_fn), rows // global_batch_size
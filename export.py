@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import numpy as np
+import tensorflow as tf
+from sm_vae import VAE
+from dataloader import SelfmotionDataGenerator
+
+
+class _ServingModule(tf.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.encoder = vae.encoder
+        self.decoder = vae.decoder
+        self.heading_decoder = vae.heading_decoder
+        video_spec = tf.TensorSpec([None] + list(vae.input_shape), tf.float32, name="videos")
+        latent_spec = tf.TensorSpec([None, vae.latent_space_dim], tf.float32, name="latents")
+        self.encode = tf.function(lambda videos: {"latents": self.encoder(videos, training=False)}, input_signature=[video_spec])
+        self.decode = tf.function(lambda latents: {"videos": self.decoder(latents, training=False)}, input_signature=[latent_spec])
+        self.predict_heading = tf.function(lambda latents: {"heading": self.heading_decoder(latents, training=False)}, input_signature=[latent_spec])
+
+
+def export_saved_model(vae, out_dir):
+    """
+    Writes encoder, decoder and heading decoder as one SavedModel with the signatures encode (videos ->
+    latents), decode (latents -> videos) and predict_heading (latents -> heading), any batch size.
+    """
+    module = _ServingModule(vae)
+    signatures = {
+        "encode": module.encode.get_concrete_function(),
+        "decode": module.decode.get_concrete_function(),
+        "predict_heading": module.predict_heading.get_concrete_function(),
+        "serving_default": module.decode.get_concrete_function(),
+    }
+    path = os.path.join(out_dir, "saved_model")
+    tf.saved_model.save(module, path, signatures=signatures)
+    return path
+
+
+def export_onnx(vae, out_dir, opset=13):
+    # tf2onnx is only needed for this export
+    import tf2onnx
+    paths = {}
+    for model in [vae.encoder, vae.decoder, vae.heading_decoder]:
+        spec = [tf.TensorSpec([None] + list(model.input_shape[1:]), tf.float32, name="input")]
+        paths[model.name] = os.path.join(out_dir, f"{model.name.lower()}.onnx")
+        tf2onnx.convert.from_keras(model, input_signature=spec, opset=opset, output_path=paths[model.name])
+    return paths
+
+
+def export_tflite(model, path, quantization=None, calibration=None):
+    """
+    Converts a Keras sub-model to TFLite. quantization is None (float32), "float16" (float16 weights) or
+    "int8" (int8 weights and activations, calibrated on the `calibration` inputs, ops without an int8
+    kernel stay float).
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if calibration is None:
+            raise ValueError("int8 quantization needs calibration inputs")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([c[np.newaxis].astype(np.float32)] for c in calibration)
+    elif quantization is not None:
+        raise ValueError(f"Invalid quantization {quantization}, currently supported are: float16 and int8")
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+    return path
+
+
+def _tflite_runner(path, batch_size):
+    interpreter = tf.lite.Interpreter(model_path=path)
+    input_index = interpreter.get_input_details()[0]["index"]
+    interpreter.resize_tensor_input(input_index, [batch_size] + list(interpreter.get_input_details()[0]["shape"][1:]))
+    interpreter.allocate_tensors()
+    output_index = interpreter.get_output_details()[0]["index"]
+
+    def run(x):
+        interpreter.set_tensor(input_index, x.astype(np.float32))
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index)
+    return run
+
+
+def _latency(fn, x, repeats):
+    fn(x)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(x)
+    return (time.perf_counter() - start) / repeats
+
+
+def calibration_latents(vae, path, samples=256, batch_size=16):
+    # latents of the first clips of a shuffled dataset, they are the inputs the decoders see in practice
+    data = SelfmotionDataGenerator(path, batch_size, list(vae.input_shape[:3]), grayscale=vae.input_shape[3] == 1, shuffle=True, seed=0, normalize=not vae.normalize_input)
+    latents = []
+    for i in range(min(len(data), int(np.ceil(samples / batch_size)))):
+        latents.append(vae.encode(data[i][0]))
+    return np.concatenate(latents)[:samples]
+
+
+def compare_variants(reference, variants, inputs, repeats=20):
+    """
+    Size, CPU latency at batch size 1 and error against the float32 Keras model for every TFLite file
+    in variants ({name: path}), evaluated on the inputs.
+    """
+    expected = reference.predict(inputs, verbose=0)
+    report = {"keras_float32": {"latency_s": _latency(lambda x: reference(x, training=False), inputs[:1], repeats)}}
+    for name, path in variants.items():
+        run = _tflite_runner(path, 1)
+        outputs = np.concatenate([run(inputs[i:i + 1]) for i in range(len(inputs))])
+        report[name] = {
+            "size_mb": os.path.getsize(path) / 1e6,
+            "latency_s": _latency(run, inputs[:1], repeats),
+            "mse": float(np.mean((outputs - expected) ** 2)),
+            "max_abs_error": float(np.max(np.abs(outputs - expected)))
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a trained model as SavedModel, ONNX and quantized TFLite')
+
+    parser.add_argument('--model', help='folder containing parameters and weights of the model')
+    parser.add_argument('--out', help='output folder, defaults to <model>/export', default=None)
+    parser.add_argument('--dataset', help='dataset csv the calibration latents are encoded from')
+    parser.add_argument('--calibration-samples', help='number of clips used for int8 calibration, as many other clips are used for the error report', default=128)
+    parser.add_argument('--onnx', help='Boolean whether ONNX files are written too (needs tf2onnx)', default="False")
+    parser.add_argument('--repeats', help='calls per latency measurement', default=20)
+
+    args = parser.parse_args()
+
+    out_dir = args.out or os.path.join(args.model, "export")
+    os.makedirs(out_dir, exist_ok=True)
+
+    vae = VAE.load(args.model, components=["encoder", "decoder", "heading_decoder"])
+    results = {
+        "date": datetime.datetime.now().isoformat(),
+        "model": args.model,
+        "saved_model": export_saved_model(vae, out_dir)
+    }
+    if args.onnx == "True":
+        results["onnx"] = export_onnx(vae, out_dir)
+
+    # int8 is calibrated on the first half, the errors are reported on the held-out second half
+    samples = int(args.calibration_samples)
+    latents = calibration_latents(vae, args.dataset, samples=2 * samples)
+    calibration, held_out = latents[:samples], latents[samples:]
+    results["variants"] = {}
+    for model in [vae.decoder, vae.heading_decoder]:
+        variants = {}
+        for quantization in [None, "float16", "int8"]:
+            name = f"tflite_{quantization or 'float32'}"
+            variants[name] = export_tflite(model, os.path.join(out_dir, f"{model.name.lower()}_{quantization or 'float32'}.tflite"), quantization, calibration=calibration)
+        results["variants"][model.name] = compare_variants(model, variants, held_out, repeats=int(args.repeats))
+
+    with open(os.path.join(out_dir, "report.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+    for model_name, report in results["variants"].items():
+        for name, r in report.items():
+            size = f"{r['size_mb']:8.2f} MB" if "size_mb" in r else " " * 11
+            error = f"mse: {r['mse']:.3e}  max: {r['max_abs_error']:.3e}" if "mse" in r else ""
+            print(f"{model_name:16s} {name:16s} {size}  {r['latency_s']*1000:8.2f} ms  {error}")
+    print(f"saved in {out_dir}")
@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from dataloader import SelfmotionDataGenerator, read_clip, finish_batch
+
+# Latent store layout (one folder per model weights + dataset, see store_key):
+#   meta.json     key, model, csv, latent_dim, count (valid rows), capacity (allocated rows)
+#   <field>.dat   raw memory maps of capacity rows: mean, log_var, latent (N x latent_dim), labels (N x 6 raw
+#                 velX..roll), heading (N x 6 prediction of the heading decoder from the mean), rows (N, csv row)
+
+
+def store_key(vae, path, decode_options={}):
+    """
+    sha1 over the encoder and heading decoder weights, the model input shape and the csv content plus decode
+    options, any change of model or dataset gives a new store.
+    """
+    h = hashlib.sha1()
+    for model in [vae.encoder, vae.heading_decoder]:
+        for w in model.get_weights():
+            h.update(np.ascontiguousarray(w).tobytes())
+    with open(path, "rb") as f:
+        h.update(f.read())
+    h.update(json.dumps([list(map(int, vae.input_shape)), bool(vae.normalize_input), decode_options], sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class LatentStore:
+    """
+    Append-only arrays of per clip encodings backed by memory maps. store[i] returns one record,
+    store[indices] / store[a:b] the records as dict of arrays, store.field (e.g. store.mean) the memory
+    map of a field limited to the valid rows.
+    """
+    def __init__(self, folder, latent_dim=None, mode="r+", meta=None):
+        self.folder = folder
+        meta_path = os.path.join(folder, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                self.meta = json.load(f)
+        else:
+            if latent_dim is None:
+                raise ValueError(f"{folder} contains no latent store, latent_dim is needed to create one")
+            os.makedirs(folder, exist_ok=True)
+            self.meta = dict(meta or {}, latent_dim=int(latent_dim), count=0, capacity=0)
+            self._write_meta()
+        self.mode = mode
+        self._maps = {}
+
+    @property
+    def fields(self):
+        d = self.meta["latent_dim"]
+        return {"mean": ((d,), np.float32), "log_var": ((d,), np.float32), "latent": ((d,), np.float32), "labels": ((6,), np.float32), "heading": ((6,), np.float32), "rows": ((), np.int64)}
+
+    def _write_meta(self):
+        tmp = os.path.join(self.folder, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.folder, "meta.json"))
+
+    def _map(self, name):
+        if name not in self._maps:
+            shape, dtype = self.fields[name]
+            capacity = self.meta["capacity"]
+            if capacity == 0:
+                return np.empty((0,) + shape, dtype=dtype)
+            self._maps[name] = np.memmap(os.path.join(self.folder, f"{name}.dat"), dtype=dtype, mode=self.mode, shape=(capacity,) + shape)
+        return self._maps[name]
+
+    def _reserve(self, n):
+        # grows the files to at least n rows, doubling so appends stay amortized O(1)
+        if n <= self.meta["capacity"]:
+            return
+        capacity = max(n, 2 * self.meta["capacity"], 1024)
+        self.flush()
+        self._maps = {}
+        for name, (shape, dtype) in self.fields.items():
+            with open(os.path.join(self.folder, f"{name}.dat"), "ab") as f:
+                f.truncate(capacity * int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self.meta["capacity"] = capacity
+        self._write_meta()
+
+    def append(self, **records):
+        """
+        Appends the same number of rows to every field (mean, log_var, latent, labels, heading, rows).
+        The count is only advanced once all fields are written.
+        """
+        missing = set(self.fields) - set(records)
+        if missing:
+            raise ValueError(f"append needs all fields, missing {sorted(missing)}")
+        n = len(records["rows"])
+        start = self.meta["count"]
+        self._reserve(start + n)
+        for name in self.fields:
+            self._map(name)[start:start + n] = records[name]
+        self.flush()
+        self.meta["count"] = start + n
+        self._write_meta()
+
+    def flush(self):
+        for m in self._maps.values():
+            m.flush()
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def __getattr__(self, name):
+        if name in ("meta", "_maps", "folder", "mode") or name not in self.fields:
+            raise AttributeError(name)
+        return self._map(name)[:len(self)]
+
+    def __getitem__(self, index):
+        return {name: self._map(name)[:len(self)][index] for name in self.fields}
+
+
+def encode_dataset(vae, path, store_dir="tmp/latent_store", batch_size=64, workers=0, decode_options={}):
+    """
+    Streams the clips of a selfmotion csv in csv order through the encoder and appends mean, log_var,
+    a sampled latent, the raw labels and the heading prediction of every clip to the LatentStore in
+    store_dir/<store_key>. An interrupted run continues after the last stored batch. Returns the store.
+    """
+    key = store_key(vae, path, decode_options)
+    store = LatentStore(os.path.join(store_dir, key), latent_dim=vae.latent_space_dim, meta={"key": key, "model": vae.name, "csv": os.path.abspath(path), "decode_options": decode_options})
+    data = pd.read_csv(f"{path}", sep=",")
+    labels = data.loc[:, "velX": "roll"].to_numpy(dtype=np.float32)
+    n = len(data)
+    if len(store) >= n:
+        return store
+
+    input_shape = list(vae.input_shape[:3])
+    grayscale = vae.input_shape[3] == 1
+    normalize = not vae.normalize_input
+
+    def add(X, rows):
+        mean, log_var, latent, heading = vae.encode_stats(X, batch_size=batch_size)
+        store.append(mean=mean, log_var=log_var, latent=latent, labels=labels[rows], heading=heading, rows=rows)
+
+    # whole batches through the loader (optionally with prefetch workers), the last partial batch directly
+    gen = SelfmotionDataGenerator(path, batch_size, input_shape, grayscale=grayscale, shuffle=False, workers=workers, normalize=normalize,
+                                  resize_method=decode_options.get("method", "bilinear"), antialias=decode_options.get("antialias", True),
+                                  ffmpeg_resize=decode_options.get("ffmpeg_resize", False), start_frame=decode_options.get("start", 0), frame_stride=decode_options.get("stride", 1))
+    first = len(store) // batch_size
+    gen.set_position(0, first)
+    try:
+        for i in tqdm(range(first, first + len(gen)), initial=first, total=n // batch_size):
+            add(gen[i - first][0], np.arange(i * batch_size, (i + 1) * batch_size))
+    finally:
+        if gen.prefetcher is not None:
+            gen.prefetcher.close()
+
+    rest = np.arange(len(store), n)
+    if len(rest):
+        base_path = os.path.dirname(path)
+        clips = np.stack([read_clip(os.path.join(base_path, data["file_head"][r]), input_shape, grayscale, **decode_options) for r in rest])
+        add(finish_batch(clips, normalize), rest)
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Encode a selfmotion dataset once into a latent store')
+
+    parser.add_argument('--model', help='folder containing parameters and weights of the model')
+    parser.add_argument('--dataset', help='dataset csv to encode')
+    parser.add_argument('--out', help='root folder of the latent stores', default="tmp/latent_store")
+    parser.add_argument('--batch-size', help='clips per encoder call', default=64)
+    parser.add_argument('--workers', help='number of decoding processes', default=4)
+
+    args = parser.parse_args()
+
+    from sm_vae import VAE
+    vae = VAE.load(args.model, components=["encoder", "heading_decoder"])
+    store = encode_dataset(vae, args.dataset, args.out, batch_size=int(args.batch_size), workers=int(args.workers))
+    print(f"{len(store)} clips encoded in {store.folder}")
@@ -8,10 +8,12 @@ from analysis import save_video
 from matplotlib import pyplot as plt
 from skimage.metrics import structural_similarity
 import argparse
+import os
 from optimizer.FDGDOptimizer import FDGDOptimizer
 from optimizer.NSEOptimizer import NSEOptimizer
 from optimizer.GeneticOptimizer import GeneticOptimizer
 from optimizer.losses import mse, ssmi
+from profiling import run_dir, parse_window, StepTrace, python_profile
 
 if __name__ == "__main__":
 
@@ -25,6 +27,10 @@ if __name__ == "__main__":
     parser.add_argument('--save-intervall', help='after how many interations a video is saved', default="50")
 
     parser.add_argument('--prefix', help='prefix of files for sorting', default="")
+    parser.add_argument('--dataset', help='dataset csv the ground truth is taken from (e.g. one written by synthetic.py)', default="N:\\Datasets\\selfmotion\\20220930-134704_1.csv")
+    parser.add_argument('--profile-iterations', help='optional, window of optimizer iterations traced with tf.profiler, e.g. 5-10', default=None)
+    parser.add_argument('--profile-python', help='Boolean whether the Python side (optimizer step, ssmi, ...) is profiled with cProfile', default="False")
+    parser.add_argument('--profile-dir', help='folder the profiles of this run are written to (profiles/<prefix>_<time>), see profiling.py summary', default="profiles")
 
     args = parser.parse_args()
 
@@ -41,16 +47,17 @@ if __name__ == "__main__":
     prefix = args.prefix
     prefix = "nse"
 
-    generator = VAE.load(model)
+    # the optimization loop never trains, the full models are not needed
+    generator = VAE.load(model, components=["encoder", "decoder", "heading_decoder"])
 
     batch_size = 1
     video_dim = generator.input_shape
 
-    dataset = "20220930-134704_1.csv" # trainingset
+    dataset = os.path.basename(args.dataset)
     # dataset = "20221110-174245_1_ws.csv"
 
     # data = SelfmotionDataGenerator(f"/mnt/masc_home/kressal/datasets/selfmotion/{dataset}", batch_size, video_dim, grayscale=True, shuffle=True)
-    data = SelfmotionDataGenerator(f"N:\\Datasets\\selfmotion\\{dataset}", batch_size, video_dim, grayscale=True, shuffle=True)
+    data = SelfmotionDataGenerator(args.dataset, batch_size, video_dim, grayscale=True, shuffle=True)
     y_true = data[0][0][0]
     # y_true = data[0][1][0]
     reconstructed_images, latent_representations, predicted_heading = generator.reconstruct(np.expand_dims(y_true, 0))
@@ -72,21 +79,30 @@ if __name__ == "__main__":
 
     x = np.arange(iterations) * sample_points * 2
 
+    profile_window = parse_window(args.profile_iterations)
+    profile_python = args.profile_python == "True"
+    profile_dir = run_dir(prefix or "optimizer", args.profile_dir) if profile_window is not None or profile_python else None
+    trace = StepTrace(profile_dir, profile_window)
+
     t = tqdm(np.arange(iterations))
     # t = np.arange(iterations)
-    for i in t:
-        # print(f"{i}/{t.size}")
-        optimizer.step()
-        current_guess = optimizer.generator.decoder.predict(np.expand_dims(optimizer.c0, 0))
-        predicted_heading = optimizer.generator.heading_decoder.predict(np.expand_dims(optimizer.c0, 0))
-        rating[i] = ssmi(y_true.squeeze(), current_guess.squeeze())
-        distance[i] = np.linalg.norm(optimizer.c0-latent_representations, 2)
-        embedding_error[i] = mse(latent_representations, optimizer.c0)
-        heading_error[i] = mse(data[0][1][1], predicted_heading)
-        # t.set_description(f"rating: {rating[i]:.4f}, mean delta_y: {optimizer.delta_y.mean():.4f}", refresh=True)
-        t.set_description(f"rating: {rating[i]:.4f}", refresh=True)
-        if i%save_intervall == 0:
-            save_video(f"optimizer_results/{prefix}__it_{i}#sp_{sample_points}#lr_{learning_rate}#sr_{search_radius}#rating_{rating[i]:.4f}_guess.mp4", current_guess[0]*255)
+    with python_profile(profile_dir, enabled=profile_python):
+        for i in t:
+            # print(f"{i}/{t.size}")
+            trace.step(i)
+            optimizer.step()
+            current_guess, predicted_heading = optimizer.generator.generate(np.expand_dims(optimizer.c0, 0))
+            rating[i] = ssmi(y_true.squeeze(), current_guess.squeeze())
+            distance[i] = np.linalg.norm(optimizer.c0-latent_representations, 2)
+            embedding_error[i] = mse(latent_representations, optimizer.c0)
+            heading_error[i] = mse(data[0][1][1], predicted_heading)
+            # t.set_description(f"rating: {rating[i]:.4f}, mean delta_y: {optimizer.delta_y.mean():.4f}", refresh=True)
+            t.set_description(f"rating: {rating[i]:.4f}", refresh=True)
+            if i%save_intervall == 0:
+                save_video(f"optimizer_results/{prefix}__it_{i}#sp_{sample_points}#lr_{learning_rate}#sr_{search_radius}#rating_{rating[i]:.4f}_guess.mp4", current_guess[0]*255)
+        trace.stop()
+    if profile_dir is not None:
+        print(f"profiles in {profile_dir}, see python profiling.py summary {profile_dir}")
 
     save_video(f"optimizer_results/{prefix}__it_{i}#sp_{sample_points}#lr_{learning_rate}#sr_{search_radius}#rating_{rating[i]:.4f}_guess.mp4", current_guess[0]*255)
 
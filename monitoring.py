@@ -0,0 +1,151 @@
+import os
+import csv
+import time
+import resource
+import collections
+import tensorflow as tf
+
+
+def host_rss_mb():
+    # current resident set size, the peak if /proc is not available
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+class TimedSequence(tf.keras.utils.Sequence):
+    """
+    Wraps a Sequence passed to fit and records when each requested batch was ready. Keras requests the
+    batches in training order (possibly ahead, from its enqueuer), so the k-th ready time belongs to the
+    k-th train step. on_epoch_end, get_state and set_position are passed on.
+    """
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.ready = collections.deque()
+
+    def __getitem__(self, index):
+        batch = self.sequence[index]
+        self.ready.append(time.perf_counter())
+        return batch
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+    def __getattr__(self, name):
+        if name == "sequence":
+            raise AttributeError(name)
+        return getattr(self.sequence, name)
+
+
+class ThroughputMonitor(tf.keras.callbacks.Callback):
+    """
+    Records per step and per epoch: samples/s, step time, time the step waited for its batch (only for
+    Sequences wrapped in TimedSequence), host RSS and per epoch the time spent in validation and writing
+    checkpoints. Writes TensorBoard scalars to log_dir/throughput and steps.csv / epochs.csv in log_dir,
+    and warns when more than input_bound_fraction of the epoch was spent waiting for data.
+    """
+    def __init__(self, log_dir, batch_size=None, timed_sequence=None, checkpoint_manager=None, log_every=10, input_bound_fraction=0.2):
+        super().__init__()
+        self.log_dir = log_dir
+        self.batch_size = batch_size
+        self.timed_sequence = timed_sequence
+        self.checkpoint_manager = checkpoint_manager
+        self.log_every = log_every
+        self.input_bound_fraction = input_bound_fraction
+
+        os.makedirs(log_dir, exist_ok=True)
+        self.writer = tf.summary.create_file_writer(os.path.join(log_dir, "throughput"))
+        self.step = 0
+
+    def _open_csv(self, name, header):
+        # appends, one monitor may see several fit calls (see VAE.train)
+        path = os.path.join(self.log_dir, name)
+        new = not os.path.exists(path)
+        f = open(path, "a", newline="")
+        if new:
+            csv.writer(f).writerow(header)
+        return f, csv.writer(f)
+
+    def on_train_begin(self, logs=None):
+        if self.timed_sequence is not None:
+            # Keras peeks at the first batch to infer shapes before training
+            self.timed_sequence.ready.clear()
+        self.step_file, self.step_csv = self._open_csv("steps.csv", ["step", "epoch", "batch", "step_s", "input_wait_s", "samples_per_s", "rss_mb"])
+        self.epoch_file, self.epoch_csv = self._open_csv("epochs.csv", ["epoch", "seconds", "train_s", "input_wait_s", "input_wait_fraction", "samples_per_s", "validation_s", "checkpoint_s", "rss_mb"])
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self._epoch_start = time.perf_counter()
+        self._train_s, self._wait_s, self._samples, self._validation_s = 0, 0, 0, 0
+        self._checkpoint_start = self._checkpoint_seconds()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._batch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.perf_counter()
+        step_s = end - self._batch_start
+        wait_s = None
+        if self.timed_sequence is not None and self.timed_sequence.ready:
+            # the batch of this step was ready at `ready`, anything after the step began was spent waiting
+            ready = self.timed_sequence.ready.popleft()
+            wait_s = min(max(0., ready - self._batch_start), step_s)
+            self._wait_s += wait_s
+        self._train_s += step_s
+        self._samples += self.batch_size or 0
+        samples_per_s = self.batch_size / step_s if self.batch_size else None
+
+        if self.step % self.log_every == 0:
+            rss = host_rss_mb()
+            self.step_csv.writerow([self.step, self.epoch, batch, step_s, wait_s, samples_per_s, rss])
+            with self.writer.as_default(step=self.step):
+                tf.summary.scalar("step/step_seconds", step_s)
+                tf.summary.scalar("step/rss_mb", rss)
+                if wait_s is not None:
+                    tf.summary.scalar("step/input_wait_seconds", wait_s)
+                if samples_per_s is not None:
+                    tf.summary.scalar("step/samples_per_second", samples_per_s)
+        self.step += 1
+
+    def on_test_begin(self, logs=None):
+        self._validation_start = time.perf_counter()
+
+    def on_test_end(self, logs=None):
+        self._validation_s += time.perf_counter() - self._validation_start
+
+    def _checkpoint_seconds(self):
+        if self.checkpoint_manager is None:
+            return 0
+        return self.checkpoint_manager.snapshot_seconds + self.checkpoint_manager.write_seconds
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self._epoch_start
+        checkpoint_s = self._checkpoint_seconds() - self._checkpoint_start
+        wait_fraction = self._wait_s / self._train_s if self.timed_sequence is not None and self._train_s > 0 else None
+        samples_per_s = self._samples / self._train_s if self._samples and self._train_s > 0 else None
+        rss = host_rss_mb()
+        self.epoch_csv.writerow([epoch, seconds, self._train_s, self._wait_s if self.timed_sequence is not None else None, wait_fraction, samples_per_s, self._validation_s, checkpoint_s, rss])
+        self.step_file.flush()
+        self.epoch_file.flush()
+        with self.writer.as_default(step=epoch):
+            tf.summary.scalar("epoch/seconds", seconds)
+            tf.summary.scalar("epoch/validation_seconds", self._validation_s)
+            tf.summary.scalar("epoch/checkpoint_seconds", checkpoint_s)
+            tf.summary.scalar("epoch/rss_mb", rss)
+            if wait_fraction is not None:
+                tf.summary.scalar("epoch/input_wait_fraction", wait_fraction)
+            if samples_per_s is not None:
+                tf.summary.scalar("epoch/samples_per_second", samples_per_s)
+        self.writer.flush()
+        if wait_fraction is not None and wait_fraction > self.input_bound_fraction:
+            print(f"\nWARNING: epoch {epoch} is input bound, {wait_fraction:.0%} of the train step time was spent waiting for batches (see loader workers / caching in dataloader.py)")
+
+    def on_train_end(self, logs=None):
+        self.step_file.close()
+        self.epoch_file.close()
+        self.writer.flush()
@@ -30,7 +30,7 @@ class FDGDOptimizer:
         self.c0 += self.learning_rate * delta_c0
 
     def _rate_vector(self, c):
-        decoded = self.generator.decoder.predict(c)
+        decoded = self.generator.decode(c)
         # heading = self.generator.heading_decoder(c)
         # return mse(self.y_true, decoded[0])
         # return -mse(self.y_true.squeeze(), decoded[0].squeeze())
@@ -21,7 +21,7 @@ class GeneticOptimizer:
         self.c0 = np.zeros(self.generator.latent_space_dim)
 
     def step(self):
-        decoded = self.generator.decoder.predict(self.population)
+        decoded = self.generator.decode(self.population)
         mutation_candidates = random.sample(list(range(self.n)), int(self.n*self.r))
         vf = np.zeros(self.n)
         for i in np.arange(decoded.shape[0]):
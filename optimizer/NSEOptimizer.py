@@ -70,7 +70,7 @@ class NSEOptimizer:
 
 
     def _rate_vector(self, c):
-        decoded = self.generator.decoder.predict(c)
+        decoded = self.generator.decode(c)
         # heading = self.generator.heading_decoder(c)
         # return mse(self.y_true, decoded[0])
         # return -mse(self.y_true.squeeze(), decoded[0].squeeze())
@@ -0,0 +1,159 @@
+import os
+import glob
+import pstats
+import cProfile
+import argparse
+import datetime
+import contextlib
+import collections
+import tensorflow as tf
+
+# Profiles of one run live in one folder (see run_dir):
+#   tf/plugins/profile/<timestamp>/*.xplane.pb   tf.profiler trace of the step window, also viewable in
+#                                                 TensorBoard (tensorboard --logdir <run dir>/tf)
+#   python.prof                                   cProfile stats of the Python side
+# `python profiling.py summary <run dir>` prints the top ops and Python functions by self time.
+
+
+def run_dir(name, root="profiles"):
+    path = os.path.join(root, f"{name}_" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def parse_window(window):
+    # "10-20" -> (10, 20), the first and the last step that are traced
+    if window is None:
+        return None
+    first, last = window.split("-")
+    return int(first), int(last)
+
+
+class StepTrace:
+    """
+    Traces steps first..last (inclusive) with tf.profiler, call step(i) before every step and stop()
+    after the loop. Works on CPU only hosts, the trace then holds the host ops. Without a window nothing
+    is traced and folder may be None.
+    """
+    def __init__(self, folder, window):
+        self.folder = os.path.join(folder, "tf") if folder is not None else None
+        self.window = window
+        self.active = False
+
+    def step(self, i):
+        if self.window is None:
+            return
+        if i == self.window[0] and not self.active:
+            tf.profiler.experimental.start(self.folder)
+            self.active = True
+        elif i == self.window[1] + 1 and self.active:
+            self.stop()
+
+    def stop(self):
+        if self.active:
+            tf.profiler.experimental.stop()
+            self.active = False
+
+
+class ProfilerCallback(tf.keras.callbacks.Callback):
+    # StepTrace over the global train step count of model.fit
+    def __init__(self, folder, window):
+        super().__init__()
+        self.trace = StepTrace(folder, window)
+        self.global_step = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.trace.step(self.global_step)
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.global_step += 1
+        if self.trace.window is not None and self.global_step == self.trace.window[1] + 1:
+            self.trace.stop()
+
+    def on_train_end(self, logs=None):
+        self.trace.stop()
+
+
+@contextlib.contextmanager
+def python_profile(folder, enabled=True):
+    # cProfile of everything inside the with block, written to folder/python.prof
+    if not enabled:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(folder, "python.prof"))
+
+
+def _xplane_pb2():
+    try:
+        from tsl.profiler.protobuf import xplane_pb2
+    except ImportError:
+        try:
+            from tensorflow.tsl.profiler.protobuf import xplane_pb2
+        except ImportError:
+            from tensorflow.core.profiler.protobuf import xplane_pb2
+    return xplane_pb2
+
+
+def op_self_times(folder):
+    """
+    Self time in seconds and number of calls per event name over all xplane traces below folder. Events
+    on the same line that lie inside another event are its children, their time is not self time.
+    """
+    xplane_pb2 = _xplane_pb2()
+    totals = collections.defaultdict(lambda: [0., 0])
+    for file in glob.glob(os.path.join(folder, "**", "*.xplane.pb"), recursive=True):
+        space = xplane_pb2.XSpace()
+        with open(file, "rb") as f:
+            space.ParseFromString(f.read())
+        for plane in space.planes:
+            names = {i: m.display_name or m.name for i, m in plane.event_metadata.items()}
+            for line in plane.lines:
+                stack = []
+                for event in sorted(line.events, key=lambda e: (e.offset_ps, -e.duration_ps)):
+                    end = event.offset_ps + event.duration_ps
+                    while stack and stack[-1][1] <= event.offset_ps:
+                        stack.pop()
+                    if stack:
+                        totals[stack[-1][0]][0] -= event.duration_ps
+                    name = names.get(event.metadata_id, str(event.metadata_id))
+                    totals[name][0] += event.duration_ps
+                    totals[name][1] += 1
+                    stack.append((name, end))
+    return {name: (ps / 1e12, calls) for name, (ps, calls) in totals.items()}
+
+
+def summary(folder, top=20):
+    if glob.glob(os.path.join(folder, "**", "*.xplane.pb"), recursive=True):
+        print(f"top {top} ops by self time")
+        ops = sorted(op_self_times(folder).items(), key=lambda item: -item[1][0])
+        for name, (seconds, calls) in ops[:top]:
+            print(f"{seconds*1000:12.2f} ms {calls:8d} calls  {name}")
+    else:
+        print(f"no tf.profiler trace in {folder}")
+
+    python_stats = os.path.join(folder, "python.prof")
+    if os.path.exists(python_stats):
+        print(f"\ntop {top} Python functions by self time")
+        pstats.Stats(python_stats).sort_stats("tottime").print_stats(top)
+    else:
+        print(f"no Python profile in {folder}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Profile summaries of train.py / main.py runs')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    summary_parser = subparsers.add_parser("summary", help='print the top ops and Python functions by self time')
+    summary_parser.add_argument('folder', help='profile folder of a run (profiles/<run>)')
+    summary_parser.add_argument('--top', help='number of entries', default=20)
+
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        summary(args.folder, top=int(args.top))
@@ -0,0 +1,274 @@
+import os
+import json
+import mmap
+import zlib
+import struct
+import argparse
+import functools
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tqdm import tqdm
+from dataloader import read_clip, finish_batch
+
+# Sharded dataset layout (one folder):
+#   shard-00000.bin ...  records of <uint64 little endian length><clip bytes>, clip bytes are the uint8 clip
+#                        (T x H x W x C), zlib compressed if the index says so
+#   index.json           clip shape, compression, csv, shard file names
+#   records.npy          N x 3 int64 (shard, byte offset of the record, record length), in record order
+#   labels.npy           N x 6 raw velX..roll labels, in record order
+
+_LENGTH = struct.Struct("<Q")
+LABEL_SCALE = np.array([1, 1, 1, 180, 180, 180])
+
+
+def convert_to_shards(path, out_dir, input_shape, grayscale=True, shard_size=1024, compression=None, workers=4, **decode_options):
+    """
+    Packs the clips and labels of a selfmotion CSV into a few large shard files that can be read
+    sequentially. Clips are decoded by `workers` processes (see dataloader.read_clip for decode_options).
+    """
+    base_path = os.path.dirname(path)
+    data = pd.read_csv(f"{path}", sep=",")
+    paths = [os.path.join(base_path, f) for f in data["file_head"]]
+    clip_shape = list(input_shape[:3]) + [1 if grayscale else 3]
+    os.makedirs(out_dir, exist_ok=True)
+
+    read = functools.partial(read_clip, input_shape=input_shape[:3], grayscale=grayscale, **decode_options)
+    pool = mp.get_context("spawn").Pool(workers) if workers > 0 else None
+    clips = pool.imap(read, paths) if pool is not None else map(read, paths)
+
+    shard_files = []
+    records = np.empty((len(paths), 3), dtype=np.int64)
+    f = None
+    try:
+        for i, clip in enumerate(tqdm(clips, total=len(paths))):
+            if i % shard_size == 0:
+                if f is not None:
+                    f.close()
+                shard_files.append(f"shard-{len(shard_files):05d}.bin")
+                f = open(os.path.join(out_dir, shard_files[-1]), "wb")
+            payload = clip.tobytes()
+            if compression == "zlib":
+                payload = zlib.compress(payload, 1)
+            records[i] = (len(shard_files) - 1, f.tell(), _LENGTH.size + len(payload))
+            f.write(_LENGTH.pack(len(payload)))
+            f.write(payload)
+    finally:
+        if f is not None:
+            f.close()
+        if pool is not None:
+            pool.terminate()
+
+    np.save(os.path.join(out_dir, "records.npy"), records)
+    np.save(os.path.join(out_dir, "labels.npy"), data.loc[:, "velX": "roll"].to_numpy(dtype=np.float32))
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump({
+            "csv": os.path.abspath(path),
+            "clip_shape": clip_shape,
+            "grayscale": bool(grayscale),
+            "compression": compression,
+            "shards": shard_files
+        }, f, indent=2)
+    return out_dir
+
+
+def load_shard_index(folder):
+    with open(os.path.join(folder, "index.json"), "r") as f:
+        index = json.load(f)
+    index["records"] = np.load(os.path.join(folder, "records.npy"))
+    index["labels"] = np.load(os.path.join(folder, "labels.npy"))
+    return index
+
+
+def _decode_record(buf, clip_shape, compression):
+    payload = buf[_LENGTH.size:]
+    if compression == "zlib":
+        payload = zlib.decompress(payload)
+    return np.frombuffer(payload, dtype=np.uint8).reshape(clip_shape)
+
+
+def read_shard(file, clip_shape, compression):
+    # yields the clips of one shard in file order with a single sequential pass over the file
+    with open(file, "rb") as f:
+        while True:
+            header = f.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                return
+            payload = f.read(_LENGTH.unpack(header)[0])
+            yield _decode_record(header + payload, clip_shape, compression)
+
+
+class ShardedSelfmotionDataGenerator(tf.keras.utils.Sequence):
+    """
+    Reads batches from a sharded dataset (see convert_to_shards). With shuffle the shard order is shuffled
+    every epoch and the records are shuffled within windows of consecutive shards of at most window_mb MB
+    on disk (at least one shard). The shards of the current window are memory-mapped and read ahead
+    sequentially, a batch at the border touches two windows, so up to 2 * window_mb MB (or two shards,
+    if larger) are resident, in the page cache rather than the process heap. Without shuffle every batch
+    is one or two sequential reads. Batches have to be requested in order (fit(shuffle=False), see VAE.train).
+    """
+    def __init__(self, folder, batch_size, shuffle=True, seed=None, normalize=True, window_mb=512):
+        self.path = folder
+        self.index = load_shard_index(folder)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.normalize = normalize
+        self.clip_shape = self.index["clip_shape"]
+        self.records = self.index["records"]
+        self.labels = self.index["labels"] / LABEL_SCALE
+        self.n = len(self.records)
+        self.window_mb = window_mb
+        self.shard_bytes = np.array([os.path.getsize(os.path.join(folder, f)) for f in self.index["shards"]])
+
+        self.seed = int(np.random.randint(2**31)) if seed is None else seed
+        self.epoch = 0
+        self._files = {}
+        # memory maps of the shards of the current shuffle window(s), shard -> mmap
+        self._maps = {}
+        # shuffle window of every shard in the current epoch
+        self.shard_window = np.zeros(len(self.index["shards"]), dtype=np.int64)
+        self.order = self._permutation(self.epoch)
+
+    def _permutation(self, epoch):
+        if not self.shuffle:
+            return np.arange(self.n)
+        rng = np.random.default_rng([self.seed, epoch])
+        shards = rng.permutation(len(self.index["shards"]))
+        # windows of consecutive shards up to window_mb, a new one starts when the next shard does not fit
+        window_bytes = np.cumsum(self.shard_bytes[shards])
+        w, window_start = 0, 0
+        for i, shard in enumerate(shards):
+            if i > 0 and window_bytes[i] - window_start > self.window_mb * 1e6:
+                w, window_start = w + 1, window_bytes[i - 1]
+            self.shard_window[shard] = w
+        order = []
+        for window in range(w + 1):
+            records = np.flatnonzero(self.shard_window[self.records[:, 0]] == window)
+            order.append(records[rng.permutation(len(records))])
+        self._close_maps(keep=())
+        return np.concatenate(order)
+
+    def _close_maps(self, keep):
+        for shard in list(self._maps):
+            if shard not in keep:
+                self._maps.pop(shard).close()
+
+    def _file(self, shard):
+        if shard not in self._files:
+            self._files[shard] = open(os.path.join(self.path, self.index["shards"][shard]), "rb")
+        return self._files[shard]
+
+    def _window_clips(self, indices, X):
+        # shuffled records: the shards of the windows this batch touches are mapped and read ahead as a
+        # whole (sequential reads), the maps of older windows are closed
+        windows = np.unique(self.shard_window[self.records[indices, 0]])
+        needed = set(int(s) for s in np.flatnonzero(np.isin(self.shard_window, windows)))
+        self._close_maps(keep=needed)
+        for shard in needed:
+            if shard not in self._maps:
+                m = mmap.mmap(self._file(shard).fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(m, "madvise"):
+                    m.madvise(mmap.MADV_WILLNEED)
+                self._maps[shard] = m
+        for i, record in enumerate(indices):
+            shard, offset, length = self.records[record]
+            X[i] = _decode_record(self._maps[int(shard)][offset:offset + length], self.clip_shape, self.index["compression"])
+
+    def __getitem__(self, index):
+        indices = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+        X = np.empty([len(indices)] + self.clip_shape, dtype=np.uint8)
+        if self.shuffle:
+            self._window_clips(indices, X)
+            X = finish_batch(X, self.normalize)
+            return X, [X, self.labels[indices]]
+        # consecutive records of the same shard are fetched with one read
+        start = 0
+        while start < len(indices):
+            shard = self.records[indices[start], 0]
+            stop = start + 1
+            while stop < len(indices) and self.records[indices[stop], 0] == shard and indices[stop] == indices[stop - 1] + 1:
+                stop += 1
+            first, last = self.records[indices[start]], self.records[indices[stop - 1]]
+            f = self._file(shard)
+            f.seek(first[1])
+            buf = f.read(last[1] + last[2] - first[1])
+            for i in range(start, stop):
+                offset = self.records[indices[i], 1] - first[1]
+                X[i] = _decode_record(buf[offset:offset + self.records[indices[i], 2]], self.clip_shape, self.index["compression"])
+            start = stop
+        X = finish_batch(X, self.normalize)
+        return X, [X, self.labels[indices]]
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = self._permutation(self.epoch)
+
+    def get_input_shape(self):
+        return list(self.clip_shape)
+
+    def __len__(self):
+        return self.n // self.batch_size
+
+
+def make_shard_dataset(folder, batch_size, shuffle=True, seed=None, shuffle_buffer=256, normalize=True):
+    """
+    tf.data pipeline over a sharded dataset: shards are shuffled and read sequentially by parallel
+    interleave, records are mixed in a shuffle buffer and batched as (X, (X, y)).
+    """
+    index = load_shard_index(folder)
+    clip_shape = index["clip_shape"]
+    labels = (index["labels"] / LABEL_SCALE).astype(np.float32)
+    first_record = {s: np.flatnonzero(index["records"][:, 0] == s)[0] for s in range(len(index["shards"]))}
+
+    def shard_records(shard):
+        shard = int(shard)
+        for i, clip in enumerate(read_shard(os.path.join(folder, index["shards"][shard]), clip_shape, index["compression"])):
+            yield clip, labels[first_record[shard] + i]
+
+    def read(shard):
+        return tf.data.Dataset.from_generator(
+            shard_records,
+            args=(shard,),
+            output_signature=(tf.TensorSpec(clip_shape, tf.uint8), tf.TensorSpec([6], tf.float32))
+        )
+
+    ds = tf.data.Dataset.range(len(index["shards"]))
+    if shuffle:
+        ds = ds.shuffle(len(index["shards"]), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.interleave(read, cycle_length=min(4, len(index["shards"])), num_parallel_calls=tf.data.AUTOTUNE)
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer, seed=seed)
+    ds = ds.batch(batch_size, drop_remainder=True)
+    if normalize:
+        ds = ds.map(lambda x, y: (tf.cast(x, tf.float32) / 255., y), num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.map(lambda x, y: (x, (x, y)), num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack a selfmotion CSV into sequential shard files')
+
+    parser.add_argument('--csv', help='dataset csv (file_head, velX..roll)')
+    parser.add_argument('--out', help='output folder for shards and index')
+    parser.add_argument('--frames', help='frames per clip', default=8)
+    parser.add_argument('--res', help='resolution of frames (res x res)', default=256)
+    parser.add_argument('--grayscale', help='Boolean whether clips are stored as grayscale', default="True")
+    parser.add_argument('--shard-size', help='clips per shard file', default=1024)
+    parser.add_argument('--compression', help='none or zlib', default="none")
+    parser.add_argument('--workers', help='number of decoding processes', default=4)
+    parser.add_argument('--ffmpeg-resize', help='Boolean whether ffmpeg scales the frames while decoding', default="False")
+
+    args = parser.parse_args()
+
+    convert_to_shards(
+        args.csv,
+        args.out,
+        [int(args.frames), int(args.res), int(args.res)],
+        grayscale=args.grayscale == "True",
+        shard_size=int(args.shard_size),
+        compression=None if args.compression == "none" else args.compression,
+        workers=int(args.workers),
+        ffmpeg_resize=args.ffmpeg_resize == "True"
+    )
+    print(f"saved shards in {args.out}")
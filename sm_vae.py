@@ -5,6 +5,7 @@ import os
 import numpy as np
 # from sklearn.manifold import TSNE
 # import matplotlib.pyplot as plt
+import json
 import pickle
 import tensorflow as tf
 from tensorflow.keras import backend as K
@@ -15,6 +16,7 @@ import datetime
 import math
 from customLayers import SampleLayer
 from customLayers import KL_Layer
+from customLayers import RecomputeBlock
 
 # from PIL import Image
 # import glob
@@ -36,8 +38,29 @@ from customLayers import KL_Layer
 
 
 
+class VAEModel(tf.keras.Model):
+    """
+    Functional VAE_hd model whose train step can be replaced by VAE._accumulated_train_step, see
+    VAE.compile(accumulation_steps=...). Layers and saved weights are the same as for tf.keras.Model.
+    """
+    custom_train_step = None
+    custom_reset_metrics = None
+
+    def train_step(self, data):
+        if self.custom_train_step is None:
+            return super().train_step(data)
+        return self.custom_train_step(data)
+
+    def reset_metrics(self):
+        super().reset_metrics()
+        if self.custom_reset_metrics is not None:
+            self.custom_reset_metrics()
+
+
 class VAE:
-    def __init__(self,input_shape, conv_filters, conv_kernels, conv_strides, latent_space_dim, name="not_set", kl_weight=4.5e-6, data_train=None, data_val=None):
+    COMPONENTS = ("encoder", "decoder", "heading_decoder")
+
+    def __init__(self,input_shape, conv_filters, conv_kernels, conv_strides, latent_space_dim, name="not_set", kl_weight=4.5e-6, data_train=None, data_val=None, normalize_input=False, precision="float32", *, components=None, recompute_blocks=None):
         print("initializing vae...")
         self.input_shape = input_shape # [28, 28, 1]
         self.conv_filters = conv_filters # [2, 4, 8]
@@ -50,33 +73,96 @@ class VAE:
         self.data_train = data_train
         self.data_val = data_val
 
+        # if True the model takes uint8 clips (0..255) and normalizes them itself, see _build_encoder and compile
+        self.normalize_input = normalize_input
+
+        # float32, mixed_float16, mixed_bfloat16 or auto (mixed_float16 with a GPU, mixed_bfloat16 on CPU),
+        # mean / log_var, sampling, KL term and the sigmoid outputs are always computed in float32
+        self.precision = precision
+
         self.dataset = None
         self.encoder = None
         self.decoder = None
         self.heading_decoder = None
+        self.embedding_stats = None
         self.model = None
 
         self.vae = None
 
-        self._optimizer = tf.keras.optimizers.Adam(lr = 0.0001)
+        # sub-models to build, None builds all of them plus the full models needed for training
+        self.components = components
+        # conv layer names (e.g. ["conv_1", "conv_transpose_4"]) or "all", the conv + activation of these
+        # blocks are recomputed in the backward pass instead of stored (training only, see _conv_block)
+        self.recompute_blocks = recompute_blocks
         self._checkpoint_filepath = './tmp/checkpoint'
+        # checkpoint state of VAE.resume, consumed by the next train call
+        self._resume_state = None
 
         self._num_conv_layers = len(conv_filters)
         self._shape_before_bottleneck = None
         self._model_input = None
+        self._inference_fns = None
 
         self._build()
 
     @classmethod
-    def load(cls, save_folder="."):
-        parameters_path = os.path.join(save_folder, "parameters.pkl")
-        with open(parameters_path, "rb") as f:
-            parameters = pickle.load(f)
-        autoencoder = VAE(*parameters)
+    def load(cls, save_folder=".", components=None):
+        """
+        components (e.g. ["decoder", "heading_decoder"]) builds only these sub-models and reads only their
+        weights from weights.h5, such a model can run inference but not be trained or saved.
+        """
+        parameters, keywords = cls._read_parameters(save_folder)
+        autoencoder = VAE(*parameters, **keywords, components=components)
         weights_path = os.path.join(save_folder, "weights.h5")
-        autoencoder.load_weights(weights_path)
+        if components is None:
+            autoencoder.load_weights(weights_path)
+        else:
+            autoencoder.load_component_weights(weights_path)
+        return autoencoder
+
+    @classmethod
+    def resume(cls, folder, which="latest"):
+        """
+        Rebuilds the model of a checkpoint written by VAE.train (see checkpoints.CheckpointManager) in
+        `folder`, which is "latest", "best" or a checkpoint name. After compile(), train() restores the
+        optimizer, rng and loader state and continues at the epoch and batch of the checkpoint.
+        """
+        from checkpoints import load_checkpoint
+        path, weights, optimizer, state = load_checkpoint(folder, which)
+        parameters, keywords = cls._read_parameters(path)
+        autoencoder = VAE(*parameters, **keywords)
+        autoencoder.model.set_weights(weights)
+        autoencoder._resume_state = {"folder": folder, "optimizer": optimizer, **state}
+        print(f"resuming {path} at epoch {state['epoch']}, batch {state['batch']}")
         return autoencoder
 
+    @classmethod
+    def checkpoint_config(cls, folder, which="latest"):
+        """
+        Input shape, normalize_input and batch size of a checkpoint without building the model, the loaders
+        of a resumed run have to match them (batch_size is None for checkpoints that did not record it).
+        """
+        from checkpoints import checkpoint_path
+        path = checkpoint_path(folder, which)
+        parameters, _ = cls._read_parameters(path)
+        with open(os.path.join(path, "state.json"), "r") as f:
+            state = json.load(f)
+        return {
+            "input_shape": list(parameters[0]),
+            "normalize_input": parameters[9] if len(parameters) > 9 else False,
+            "batch_size": state.get("batch_size")
+        }
+
+    @staticmethod
+    def _read_parameters(folder):
+        # parameters.pkl lists the positional arguments, followed by a dict of the keyword-only ones
+        # (files written before recompute_blocks was saved have none)
+        with open(os.path.join(folder, "parameters.pkl"), "rb") as f:
+            parameters = pickle.load(f)
+        if parameters and isinstance(parameters[-1], dict):
+            return parameters[:-1], parameters[-1]
+        return parameters, {}
+
     def save(self, save_folder="."):
         # prefix = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         prefix = ""
@@ -87,22 +173,111 @@ class VAE:
     def load_weights(self, weights_path):
         self.model.load_weights(weights_path)
 
-    def reconstruct(self, images):
-        latent_representations = self.encoder.predict(images)
-        reconstructed_images = self.decoder.predict(latent_representations)
-        predicted_heading = self.heading_decoder.predict(latent_representations)
+    def load_component_weights(self, weights_path):
+        # weights.h5 holds one group per layer of self.model and the sub-models are layers of it, every
+        # group lists its weights in the order trainable + non trainable
+        import h5py
+        with h5py.File(weights_path, "r") as f:
+            if "layer_names" not in f.attrs and "model_weights" in f:
+                f = f["model_weights"]
+            for model in [self.encoder, self.decoder, self.heading_decoder]:
+                if model is None:
+                    continue
+                group = f[model.name]
+                names = [n.decode("utf8") if isinstance(n, bytes) else n for n in group.attrs["weight_names"]]
+                weights = model.trainable_weights + model.non_trainable_weights
+                if len(names) != len(weights):
+                    raise ValueError(f"{model.name} has {len(weights)} weights, {weights_path} stores {len(names)}")
+                values = [np.asarray(group[n]) for n in names]
+                for w, v in zip(weights, values):
+                    if tuple(w.shape) != v.shape:
+                        raise ValueError(f"{model.name}: shape mismatch for {w.name}, {tuple(w.shape)} vs. {v.shape} in {weights_path}")
+                K.batch_set_value(list(zip(weights, values)))
+
+    def compile_inference(self, jit_compile=False):
+        """
+        Traces the tf.functions behind encode, encode_stats, decode, predict_heading, generate and
+        reconstruct once with a fixed input signature (any batch size), optionally compiled with XLA.
+        Called on first use otherwise.
+        """
+        video_spec = tf.TensorSpec([None] + list(self.input_shape), tf.float32)
+        latent_spec = tf.TensorSpec([None, self.latent_space_dim], tf.float32)
+
+        def generate(z):
+            return self.decoder(z, training=False), self.heading_decoder(z, training=False)
+
+        def encode_stats(x):
+            mean, log_var = self.embedding_stats(x, training=False)
+            latent = mean + tf.exp(log_var / 2) * tf.random.normal(tf.shape(mean))
+            return mean, log_var, latent, self.heading_decoder(mean, training=False)
+
+        def reconstruct(x):
+            latent = self.encoder(x, training=False)
+            return self.decoder(latent, training=False), latent, self.heading_decoder(latent, training=False)
+
+        self._inference_fns = {
+            "encode": tf.function(lambda x: self.encoder(x, training=False), input_signature=[video_spec], jit_compile=jit_compile),
+            "decode": tf.function(lambda z: self.decoder(z, training=False), input_signature=[latent_spec], jit_compile=jit_compile),
+            "predict_heading": tf.function(lambda z: self.heading_decoder(z, training=False), input_signature=[latent_spec], jit_compile=jit_compile),
+            "generate": tf.function(generate, input_signature=[latent_spec], jit_compile=jit_compile),
+            "reconstruct": tf.function(reconstruct, input_signature=[video_spec], jit_compile=jit_compile),
+            "encode_stats": tf.function(encode_stats, input_signature=[video_spec], jit_compile=jit_compile),
+        }
+
+    def _infer(self, name, inputs, batch_size):
+        # runs one of the traced functions over the inputs in chunks of batch_size and returns numpy arrays,
+        # empty inputs give empty outputs. The default chunk of 32 is the one of Model.predict, decoder
+        # activations at full resolution take tens of MB per sample
+        if self._inference_fns is None:
+            self.compile_inference()
+        fn = self._inference_fns[name]
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if len(inputs) == 0:
+            empty = lambda t: np.zeros([0] + t.shape[1:].as_list(), dtype=t.dtype.as_numpy_dtype)
+            return tf.nest.map_structure(empty, fn.get_concrete_function().structured_outputs)
+        outputs = [fn(tf.constant(inputs[i:i + batch_size])) for i in range(0, len(inputs), batch_size)]
+        if isinstance(outputs[0], tuple):
+            return tuple(np.concatenate([o[k].numpy() for o in outputs]) for k in range(len(outputs[0])))
+        return np.concatenate([o.numpy() for o in outputs])
+
+    def encode(self, videos, batch_size=32):
+        return self._infer("encode", videos, batch_size)
+
+    def encode_stats(self, videos, batch_size=32):
+        # (mean, log_var, sampled latent, heading predicted from the mean) in one graph call
+        return self._infer("encode_stats", videos, batch_size)
+
+    def decode(self, latents, batch_size=32):
+        return self._infer("decode", latents, batch_size)
+
+    def predict_heading(self, latents, batch_size=32):
+        return self._infer("predict_heading", latents, batch_size)
+
+    def generate(self, latents, batch_size=32):
+        # decoder and heading decoder evaluated in one graph call, returns (videos, headings)
+        videos, headings = self._infer("generate", latents, batch_size)
+        return videos, headings
+
+    def reconstruct(self, images, batch_size=32):
+        reconstructed_images, latent_representations, predicted_heading = self._infer("reconstruct", images, batch_size)
         return reconstructed_images, latent_representations, predicted_heading
 
     def summary(self):
-        self.encoder.summary()
-        self.decoder.summary()
-        self.heading_decoder.summary()
-        self.vae.summary()
-        self.model.summary()
-
-    def compile(self, reconstruction_loss="mse", heading_weight=4.5e-1, learning_rate=0.0001):
+        for model in [self.encoder, self.decoder, self.heading_decoder, self.vae, self.model]:
+            if model is not None:
+                model.summary()
+
+    def compile(self, reconstruction_loss="mse", heading_weight=4.5e-1, learning_rate=0.0001, accumulation_steps=None):
+        """
+        accumulation_steps replaces the Keras train step by _accumulated_train_step: every batch is split
+        into that many micro-batches whose gradients are summed before one optimizer update, so the batch
+        size of the generator is decoupled from peak memory. None keeps the Keras train step.
+        """
+        if accumulation_steps is not None and accumulation_steps < 1:
+            raise ValueError(f"accumulation_steps has to be at least 1, got {accumulation_steps}")
         self._reconstruction_loss = reconstruction_loss
         self.heading_weight = heading_weight
+        self.accumulation_steps = accumulation_steps
         # optimizer = Adam(learning_rate=learning_rate)
         # if reconstruction_loss == "mse": rl = self._mse_loss
         # elif reconstruction_loss == "psnr": rl = self._psnr_loss
@@ -110,7 +285,7 @@ class VAE:
         # else: raise Exception("Invalid loss function, currently supported are: mse, psnr and ssmi")
 
         losses = {
-            "Decoder": 'mse',
+            "Decoder": self._normalized_target(tf.keras.losses.mean_squared_error, "mse") if self.normalize_input else 'mse',
             # "emembedding_stats": tf.keras.losses.KLDivergence(),
             "Heading_Decoder": 'mse'
         }
@@ -120,12 +295,15 @@ class VAE:
             "Heading_Decoder":self.heading_weight
         }
         metrics = {
-            "Decoder": 'mean_absolute_percentage_error',
+            "Decoder": self._normalized_target(tf.keras.metrics.mean_absolute_percentage_error, "mean_absolute_percentage_error") if self.normalize_input else 'mean_absolute_percentage_error',
             # "emembedding_stats": tf.keras.losses.KLDivergence(),
             "Heading_Decoder": 'accuracy'
         }
 
         optimizer = tf.optimizers.Adam(learning_rate=learning_rate)
+        if self._precision_policy() == "mixed_float16":
+            # dynamic loss scaling keeps small float16 gradients from underflowing
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
         self.model.compile(
             optimizer=optimizer,
             loss=losses,
@@ -139,52 +317,240 @@ class VAE:
             #         ]
         )
 
-    def train(self, train_gen, validation_gen, num_epochs, grayscale, checkpoint_interval=1500, verbosity=1):
+        if accumulation_steps is not None:
+            # loss trackers live outside the Keras model so they do not end up in the saved weights
+            self._loss_trackers = {name: tf.keras.metrics.Mean(name=name) for name in ["loss", "Decoder_loss", "Heading_Decoder_loss", "kl_loss"]}
+            self.model.custom_train_step = self._accumulated_train_step
+            self.model.custom_reset_metrics = lambda: [t.reset_state() for t in self._loss_trackers.values()]
+        else:
+            self.model.custom_train_step = None
+            self.model.custom_reset_metrics = None
+
+    def _accumulated_train_step(self, data):
+        # same losses and logged names as the Keras train step: loss = Decoder_loss + heading_weight *
+        # Heading_Decoder_loss + kl_loss, with kl_loss the term KL_Layer adds. The last micro-batch also takes
+        # the batch_size % accumulation_steps remaining rows, every micro-batch loss is weighted by its share
+        # of the rows so the update is the one of the whole batch. Batch norm statistics are those of the
+        # micro-batches. A batch smaller than accumulation_steps is split into micro-batches of one row.
+        x, y = data
+        recon_target, heading_target = y[0], y[1]
+        batch = tf.shape(x)[0]
+        steps = tf.minimum(self.accumulation_steps, batch)
+        size = batch // steps
+        variables = self.model.trainable_variables
+        gradients = [tf.zeros_like(v) for v in variables]
+
+        for i in tf.range(steps):
+            rows = tf.range(i * size, tf.where(i == steps - 1, batch, (i + 1) * size))
+            weight = tf.cast(tf.size(rows), tf.float32) / tf.cast(batch, tf.float32)
+            x_micro = tf.gather(x, rows)
+            with tf.GradientTape() as tape:
+                mean, log_var = self.embedding_stats(x_micro, training=True)
+                latent = mean + tf.exp(log_var / 2) * tf.random.normal(tf.shape(mean))
+                recon = self.decoder(latent, training=True)
+                heading = self.heading_decoder(latent, training=True)
+
+                target = tf.cast(tf.gather(recon_target, rows), recon.dtype)
+                if self.normalize_input:
+                    target = target / 255.
+                recon_loss = tf.reduce_mean(tf.square(target - recon))
+                heading_loss = tf.reduce_mean(tf.square(tf.cast(tf.gather(heading_target, rows), heading.dtype) - heading))
+                kl_loss = -self.kl_weight * tf.reduce_mean(1 + log_var - tf.square(mean) - tf.exp(log_var))
+                loss = recon_loss + self.heading_weight * heading_loss + kl_loss
+                # gradients are summed over micro-batches and, under a distribution strategy, over replicas
+                scaled_loss = loss * tf.cast(weight / tf.distribute.get_strategy().num_replicas_in_sync, loss.dtype)
+                if isinstance(self.model.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+                    scaled_loss = self.model.optimizer.get_scaled_loss(scaled_loss)
+            micro_gradients = tape.gradient(scaled_loss, variables)
+            if isinstance(self.model.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+                micro_gradients = self.model.optimizer.get_unscaled_gradients(micro_gradients)
+            gradients = [g + mg if mg is not None else g for g, mg in zip(gradients, micro_gradients)]
+
+            for name, value in zip(["loss", "Decoder_loss", "Heading_Decoder_loss", "kl_loss"], [loss, recon_loss, heading_loss, kl_loss]):
+                self._loss_trackers[name].update_state(value, sample_weight=weight)
+            self.model.compiled_metrics.update_state([tf.gather(recon_target, rows), tf.gather(heading_target, rows)], [recon, heading])
+
+        self.model.optimizer.apply_gradients(zip(gradients, variables))
+        logs = {m.name: m.result() for m in self.model.compiled_metrics.metrics}
+        logs.update({name: t.result() for name, t in self._loss_trackers.items()})
+        return logs
+
+    def is_chief(self):
+        # True unless the model was built under a multi worker strategy on a worker other than worker 0
+        resolver = getattr(self.model.distribute_strategy, "cluster_resolver", None)
+        if resolver is None or not resolver.cluster_spec().as_dict():
+            return True
+        if "chief" in resolver.cluster_spec().as_dict():
+            return resolver.task_type == "chief"
+        return resolver.task_type in (None, "worker") and resolver.task_id in (None, 0)
+
+    def task_id(self):
+        # index of this worker in a multi worker strategy, 0 otherwise
+        resolver = getattr(self.model.distribute_strategy, "cluster_resolver", None)
+        return 0 if resolver is None or resolver.task_id is None else resolver.task_id
+
+    def train(self, train_gen, validation_gen, num_epochs, grayscale, checkpoint_interval=1500, verbosity=1, resident_validation=None, validation_freq=1, validation_samples=None, validation_batch_size=64, steps_per_epoch=None, validation_steps=None, checkpoint_dir=None, keep_checkpoints=3, histogram_freq=1, callbacks=None):
+        """
+        resident_validation ("memory" or "mmap") decodes the clips of a SelfmotionDataGenerator passed as
+        validation_gen once as uint8 and evaluates them in batches of validation_batch_size, optionally only
+        a fixed subsample of validation_samples clips. Validation runs every validation_freq epochs.
+        steps_per_epoch / validation_steps are needed for DatasetCreators (see distributed.py), checkpoints
+        are only written by the chief. Every checkpoint_interval batches and every epoch a checkpoint is
+        written in the background to checkpoint_dir (default tmp/checkpoints/<name>), the last
+        keep_checkpoints and the best one are kept, see VAE.resume. Throughput, input stalls, memory,
+        validation and checkpoint time are logged to <log_dir>/throughput and CSVs (see monitoring.py).
+        callbacks are added to the ones above, e.g. profiling.ProfilerCallback.
+        """
         bw = "gray" if grayscale else "color"
         
-        self.data_train = train_gen.path
-        self.data_val = validation_gen.path
+        # train_gen/validation_gen may be SelfmotionDataGenerators or tf.data.Datasets (see make_selfmotion_dataset)
+        self.data_train = getattr(train_gen, "path", self.data_train)
+        self.data_val = getattr(validation_gen, "path", self.data_val)
         # tf.compat.v1.placeholder(
         #     float, shape=[None, None], name='Heading_Decoder_target'
         # )
 
-        model_checkpoint_callback = tf.keras.callbacks.ModelCheckpoint(
-            filepath="tmp/checkpoints/weights.{epoch:02d}-{loss:.2f}_"+self.name+".hdf5",
-            monitor='loss',
-            verbose = verbosity,
-            # save_best_only=True,
-            save_weights_only=True,
-            # mode='min',
-            save_freq = checkpoint_interval,
-            # period = checkpoint_interval
+        if resident_validation is not None and validation_gen is not None:
+            from dataloader import load_resident_clips, ResidentClipSequence
+            clips, labels, rows = load_resident_clips(
+                validation_gen.path,
+                validation_gen.input_shape[:3],
+                grayscale=validation_gen.grayscale,
+                samples=validation_samples,
+                mmap=resident_validation == "mmap",
+                decode_options=getattr(validation_gen, "decode_options", {})
+            )
+            validation_gen = ResidentClipSequence(clips, labels, rows, validation_batch_size, normalize=getattr(validation_gen, "normalize", True), path=validation_gen.path)
+
+        from checkpoints import CheckpointManager, optimizer_variables, restore_rng_state
+        initial_epoch, initial_batch = 0, 0
+        if self._resume_state is not None:
+            state = self._resume_state
+            variables = optimizer_variables(self.model.optimizer, self.model.trainable_variables)
+            if len(variables) != len(state["optimizer"]):
+                raise ValueError(f"checkpoint {state['folder']} holds {len(state['optimizer'])} optimizer variables, the optimizer has {len(variables)} (different precision or optimizer?)")
+            for variable, value in zip(variables, state["optimizer"]):
+                variable.assign(value)
+            restore_rng_state(state["rng"])
+            initial_epoch, initial_batch = state["epoch"], state["batch"]
+            if state["loader"] is not None and hasattr(train_gen, "set_position"):
+                train_gen.seed = state["loader"]["seed"]
+                train_gen.set_position(initial_epoch, initial_batch)
+            elif initial_batch > 0:
+                # without a loader position the interrupted epoch is repeated from its start
+                initial_batch = 0
+            checkpoint_dir = checkpoint_dir or state["folder"]
+            self._resume_state = None
+
+        checkpoint_callback = CheckpointManager(
+            self,
+            checkpoint_dir or os.path.join("tmp", "checkpoints", self.name),
+            interval=checkpoint_interval,
+            keep=keep_checkpoints,
+            train_gen=train_gen,
+            batch_offset=initial_batch,
+            verbosity=verbosity if self.is_chief() else 0,
+            chief=self.is_chief(),
+            task_id=self.task_id()
         )
         early_stopping_callback = tf.keras.callbacks.EarlyStopping(monitor='loss')
         self.log_dir = f"logs/fit/{self.name}_" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-        self.tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=self.log_dir, histogram_freq=1)
-        self.model.fit(
-            train_gen,
-            # y={
-            #    "Decoder": [None, self.input_shape[0], self.input_shape[1], self.input_shape[2], self.input_shape[3]],
-            #    "Heading_Decoder": [None, 6]
-            # },
-            validation_data=validation_gen,
-            # batch_size=batch_size,
-            verbose = verbosity,
-            epochs=num_epochs,
-            shuffle=True,
-            callbacks=[
-                self.tensorboard_callback,
-                # early_stopping_callback,
-                model_checkpoint_callback,
-                # tf.keras.callbacks.LearningRateScheduler(lambda epoch: 0.0001 * math.exp(-0.001*epoch))
-            ]
+        if not self.is_chief():
+            # workers of one run start within the same second, each logs to a folder of its own
+            self.log_dir += f"_worker{self.task_id()}"
+        self.tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=self.log_dir, histogram_freq=histogram_freq)
+
+        from monitoring import TimedSequence, ThroughputMonitor
+        fit_gen = TimedSequence(train_gen) if isinstance(train_gen, tf.keras.utils.Sequence) else train_gen
+        batch_size = getattr(train_gen, "batch_size", None)
+        if batch_size is None and isinstance(train_gen, tf.data.Dataset):
+            batch_size = train_gen.element_spec[0].shape[0]
+        self.throughput_callback = ThroughputMonitor(
+            self.log_dir,
+            batch_size=batch_size,
+            timed_sequence=fit_gen if fit_gen is not train_gen else None,
+            checkpoint_manager=checkpoint_callback
         )
 
+        # a run resumed within an epoch finishes that (shortened) epoch in a fit call of its own, Keras
+        # takes the number of steps per epoch from the first epoch
+        if initial_batch > 0:
+            stages = [(initial_epoch, initial_epoch + 1), (initial_epoch + 1, num_epochs)]
+        else:
+            stages = [(initial_epoch, num_epochs)]
+        for first_epoch, last_epoch in stages:
+            if first_epoch >= last_epoch:
+                continue
+            self.model.fit(
+                fit_gen,
+                # y={
+                #    "Decoder": [None, self.input_shape[0], self.input_shape[1], self.input_shape[2], self.input_shape[3]],
+                #    "Heading_Decoder": [None, 6]
+                # },
+                validation_data=validation_gen,
+                # batch_size=batch_size,
+                verbose = verbosity,
+                initial_epoch=first_epoch,
+                epochs=last_epoch,
+                validation_freq=validation_freq,
+                # loaders with a shuffle option shuffle themselves (seeded, resumable, prefetched or shard
+                # sequential), Keras has to request their batches in order
+                shuffle=not hasattr(train_gen, "shuffle"),
+                steps_per_epoch=steps_per_epoch,
+                validation_steps=validation_steps,
+                callbacks=[
+                    self.tensorboard_callback,
+                    self.throughput_callback,
+                    # early_stopping_callback,
+                    # tf.keras.callbacks.LearningRateScheduler(lambda epoch: 0.0001 * math.exp(-0.001*epoch))
+                    # on every worker, taking the weight snapshot is a collective under a multi worker strategy
+                    checkpoint_callback,
+                ] + list(callbacks or [])
+            )
+
     def _build(self):
-        self._build_encoder()
-        self._build_decoder()
-        self._build_heading_decoder()
-        self._build_autoencoder()
+        components = self.COMPONENTS if self.components is None else self.components
+        unknown = set(components) - set(self.COMPONENTS)
+        if unknown:
+            raise ValueError(f"Unknown components {sorted(unknown)}, valid are {self.COMPONENTS}")
+        # the layers take the policy that is global while they are created, it is restored afterwards
+        previous_policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(self._precision_policy())
+        try:
+            if "encoder" in components:
+                self._build_encoder()
+            else:
+                self._shape_before_bottleneck = self._conv_output_shape()
+            if "decoder" in components:
+                self._build_decoder()
+            if "heading_decoder" in components:
+                self._build_heading_decoder()
+            if self.components is None:
+                self._build_autoencoder()
+        finally:
+            tf.keras.mixed_precision.set_global_policy(previous_policy)
+        if self.recompute_blocks not in (None, "all"):
+            names = [f"conv_{i + 1}" for i in range(self._num_conv_layers)] + [f"conv_transpose_{i + 1}" for i in range(self._num_conv_layers)]
+            unknown = set(self.recompute_blocks) - set(names)
+            if unknown:
+                raise ValueError(f"Unknown recompute blocks {sorted(unknown)}, valid are {names}")
+
+    def _precision_policy(self):
+        if self.precision in (None, "float32"):
+            return "float32"
+        if self.precision == "auto":
+            return "mixed_float16" if tf.config.list_physical_devices("GPU") else "mixed_bfloat16"
+        if self.precision in ("mixed_float16", "mixed_bfloat16"):
+            return self.precision
+        raise ValueError(f"Invalid precision {self.precision}, currently supported are: float32, mixed_float16, mixed_bfloat16 and auto")
+
+    def _conv_output_shape(self):
+        # shape after the encoder conv blocks without building them, "same" padding gives ceil(size / stride)
+        shape = list(self.input_shape[:3])
+        for strides in self.conv_strides:
+            strides = strides if isinstance(strides, (list, tuple)) else [strides] * 3
+            shape = [math.ceil(s / st) for s, st in zip(shape, strides)]
+        return tuple(shape) + (self.conv_filters[-1],)
 
     def _build_encoder(self):
         encoder_input = tf.keras.Input(shape=self.input_shape, name='input_layer')
@@ -192,32 +558,34 @@ class VAE:
         x = encoder_input
 
         # Normalization layer
-        # x = tf.keras.layers.Rescaling(1./255, input_shape=self.input_shape, name="norm_layer")(x)
+        if self.normalize_input:
+            x = tf.keras.layers.Rescaling(1./255, name="norm_layer")(x)
 
         # Convolution blocks (conv layers + (leaky) ReLU + Batch norm)
         for layer_index in range(self._num_conv_layers):
             layer_number = layer_index + 1
-            x = tf.keras.layers.Conv3D(
+            conv = tf.keras.layers.Conv3D(
                 filters=self.conv_filters[layer_index],
                 kernel_size=self.conv_kernels[layer_index],
                 strides=self.conv_strides[layer_index],
                 padding="same",
                 name=f"conv_{layer_number}"
-            )(x)
+            )
             # x = tf.keras.layers.ReLU(name=f"relu_{layer_number}")(x)
-            x = tf.keras.layers.LeakyReLU(name=f"lrelu_{layer_number}")(x)
+            x = self._conv_block(x, conv, tf.keras.layers.LeakyReLU(name=f"lrelu_{layer_number}"))
             x = tf.keras.layers.BatchNormalization(name=f"bn_{layer_number}")(x)
 
         # Final Block
         self._shape_before_bottleneck = K.int_shape(x)[1:]
         flatten = tf.keras.layers.Flatten()(x)
-        self.mean = tf.keras.layers.Dense(self.latent_space_dim, name='mean')(flatten)
-        self.log_var = tf.keras.layers.Dense(self.latent_space_dim, name='log_var')(flatten)
+        self.mean = tf.keras.layers.Dense(self.latent_space_dim, name='mean', dtype="float32")(flatten)
+        self.log_var = tf.keras.layers.Dense(self.latent_space_dim, name='log_var', dtype="float32")(flatten)
         
-        self.mean, self.log_var = KL_Layer()([self.mean, self.log_var], fact=self.kl_weight)
-        # self.embedding_stats = tf.keras.Model(encoder_input, [self.mean, self.log_var], name="embedding_stats")
+        self.mean, self.log_var = KL_Layer(dtype="float32")([self.mean, self.log_var], fact=self.kl_weight)
+        # shares its layers with the encoder, used by the explicit train step (see compile)
+        self.embedding_stats = tf.keras.Model(encoder_input, [self.mean, self.log_var], name="embedding_stats")
 
-        output = SampleLayer(name="sample_point")([self.mean, self.log_var])
+        output = SampleLayer(name="sample_point", dtype="float32")([self.mean, self.log_var])
         self.encoder = tf.keras.Model(encoder_input, output, name="Encoder")
 
     def _build_decoder(self):
@@ -229,28 +597,38 @@ class VAE:
 
         for layer_index in reversed(range(1, self._num_conv_layers)):
             layer_num = self._num_conv_layers - layer_index
-            x = tf.keras.layers.Conv3DTranspose(
+            conv = tf.keras.layers.Conv3DTranspose(
                 filters=self.conv_filters[layer_index],
                 kernel_size=self.conv_kernels[layer_index],
                 strides=self.conv_strides[layer_index],
                 padding="same",
                 name=f"conv_transpose_{layer_num}"
-            )(x)
+            )
             # x = tf.keras.layers.ReLU(name=f"relu_{layer_num}")(x)
-            x = tf.keras.layers.LeakyReLU(name=f"lrelu_{layer_num}")(x)
+            x = self._conv_block(x, conv, tf.keras.layers.LeakyReLU(name=f"lrelu_{layer_num}"))
             x = tf.keras.layers.BatchNormalization(name=f"bn_{layer_num}")(x)
 
-        output = tf.keras.layers.Conv3DTranspose(
+        output = self._conv_block(x, tf.keras.layers.Conv3DTranspose(
             filters=self.input_shape[3],
             kernel_size=self.conv_kernels[0],
             strides=self.conv_strides[0],
             padding="same",
             activation='sigmoid',
-            name=f"conv_transpose_{self._num_conv_layers}"
-        )(x)
+            name=f"conv_transpose_{self._num_conv_layers}",
+            dtype="float32"
+        ))
 
         self.decoder = tf.keras.Model(decoder_input, output, name="Decoder")
 
+    def _conv_block(self, x, conv, activation=None):
+        # batch norm stays outside the recomputed part, it would update its moving averages twice
+        block = [conv] if activation is None else [conv, activation]
+        if self.recompute_blocks == "all" or conv.name in (self.recompute_blocks or []):
+            return RecomputeBlock(block, name=f"recompute_{conv.name}")(x)
+        for layer in block:
+            x = layer(x)
+        return x
+
     def _build_heading_decoder(self):
         # num_neurons = np.prod(self._shape_before_bottleneck)
 
@@ -258,7 +636,7 @@ class VAE:
         x = tf.keras.layers.Dense(self.latent_space_dim, activation="relu")(heading_decoder_input)
         x = tf.keras.layers.Dense(int(self.latent_space_dim/3), activation="relu")(x)
         x = tf.keras.layers.Dense(int(self.latent_space_dim/10), activation="relu")(x)
-        heading_decoder_output = tf.keras.layers.Dense(6, activation="sigmoid")(x)
+        heading_decoder_output = tf.keras.layers.Dense(6, activation="sigmoid", dtype="float32")(x)
         self.heading_decoder = tf.keras.Model(heading_decoder_input, heading_decoder_output, name="Heading_Decoder")
 
         # dense_layer = tf.keras.layers.Dense(num_neurons, name="dense_1")(dorsalNet_input)
@@ -274,7 +652,7 @@ class VAE:
         # test_layer = tf.keras.Input(shape=model_input.shape, name='input_layer')
         # test_out = tf.keras.layers.Dense(3,'relu')(test_layer)
         self.vae = tf.keras.Model(inputs=model_input, outputs=model_output_recon, name="VAE")
-        self.model = tf.keras.Model(inputs=model_input, outputs=[model_output_recon, model_output_heading], name="VAE_hd")
+        self.model = VAEModel(inputs=model_input, outputs=[model_output_recon, model_output_heading], name="VAE_hd")
         
 
     def _combined_loss(self, y_true, y_pred):
@@ -291,6 +669,13 @@ class VAE:
         combined_loss = self.kl_weight * reconstruction_loss
         return reconstruction_loss
 
+    def _normalized_target(self, fn, name):
+        # the reconstruction target is the uint8 input clip, it is scaled to [0, 1] like the input itself
+        def normalized(y_true, y_pred):
+            return fn(tf.cast(y_true, y_pred.dtype) / 255., y_pred)
+        normalized.__name__ = name
+        return normalized
+
     def _mse_loss(self, y_true, y_pred):
         # print([type(y_pred), y_pred.shape])
         # print([type(y_true), y_true.shape])
@@ -340,7 +725,10 @@ class VAE:
             self.name,
             self.kl_weight,
             self.data_train,
-            self.data_val
+            self.data_val,
+            self.normalize_input,
+            self.precision,
+            {"recompute_blocks": self.recompute_blocks}
         ]
         save_path = os.path.join(save_folder, f"{prefix}parameters.pkl")
         with open(save_path, "wb") as f:
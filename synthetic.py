@@ -0,0 +1,142 @@
+import os
+import argparse
+import functools
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import skvideo.io
+from tqdm import tqdm
+
+LABEL_COLUMNS = ["velX", "velY", "velZ", "yaw", "pitch", "roll"]
+
+
+def _rotation(yaw, pitch, roll):
+    # yaw around y, pitch around x, roll around z (degrees), camera looks along +z with y up
+    yaw, pitch, roll = np.radians([yaw, pitch, roll])
+    ry = np.array([[np.cos(yaw), 0, np.sin(yaw)], [0, 1, 0], [-np.sin(yaw), 0, np.cos(yaw)]])
+    rx = np.array([[1, 0, 0], [0, np.cos(pitch), -np.sin(pitch)], [0, np.sin(pitch), np.cos(pitch)]])
+    rz = np.array([[np.cos(roll), -np.sin(roll), 0], [np.sin(roll), np.cos(roll), 0], [0, 0, 1]])
+    return ry @ rx @ rz
+
+
+def _poses(labels, frames, fps):
+    # camera position and orientation for every frame, velocities in units/s and degrees/s in camera coordinates
+    vel, rot = np.asarray(labels[:3], dtype=float), np.asarray(labels[3:], dtype=float)
+    position = np.zeros(3)
+    poses = []
+    for t in range(frames):
+        orientation = _rotation(*(rot * t / fps))
+        poses.append((position.copy(), orientation))
+        position += orientation @ vel / fps
+    return poses
+
+
+def render_dots(labels, frames=8, res=256, fps=8, n_dots=2000, fov=90, depth=(0.5, 20), rng=None):
+    """
+    Optic flow dot field: dots scattered through a volume in front of the camera, projected with a pinhole
+    camera that moves along the velocities and rotates with yaw/pitch/roll. Returns uint8 T x H x W.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    focal = res / 2 / np.tan(np.radians(fov) / 2)
+    extent = depth[1] * np.tan(np.radians(fov) / 2)
+    dots = np.column_stack([rng.uniform(-extent, extent, n_dots), rng.uniform(-extent, extent, n_dots), rng.uniform(*depth, n_dots)])
+    clip = np.zeros((frames, res, res), dtype=np.uint8)
+    for t, (position, orientation) in enumerate(_poses(labels, frames, fps)):
+        cam = (dots - position) @ orientation
+        visible = (cam[:, 2] > depth[0]) & (cam[:, 2] < depth[1] * 2)
+        cam = cam[visible]
+        u = np.rint(res / 2 + focal * cam[:, 0] / cam[:, 2]).astype(int)
+        v = np.rint(res / 2 - focal * cam[:, 1] / cam[:, 2]).astype(int)
+        # closer dots are brighter and bigger
+        brightness = np.clip(255 * depth[0] * 4 / cam[:, 2], 64, 255).astype(np.uint8)
+        radius = np.clip(np.rint(res / 128 * depth[0] * 4 / cam[:, 2]), 0, 3).astype(int)
+        for r in np.unique(radius):
+            sel = radius == r
+            for du in range(-r, r + 1):
+                for dv in range(-r, r + 1):
+                    uu, vv = u[sel] + du, v[sel] + dv
+                    inside = (uu >= 0) & (uu < res) & (vv >= 0) & (vv < res)
+                    clip[t, vv[inside], uu[inside]] = np.maximum(clip[t, vv[inside], uu[inside]], brightness[sel][inside])
+    return clip
+
+
+def render_ground(labels, frames=8, res=256, fps=8, fov=90, height=1.5, texture_size=256, texture_scale=0.25, rng=None):
+    """
+    Textured ground plane: every pixel below the horizon is ray traced onto the plane y = -height and
+    looks up a random texture tiled over the plane, the camera moves like in render_dots. Returns uint8 T x H x W.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    texture = rng.uniform(0, 255, (texture_size // 8, texture_size // 8))
+    texture = np.kron(texture, np.ones((8, 8)))
+    focal = res / 2 / np.tan(np.radians(fov) / 2)
+    u, v = np.meshgrid(np.arange(res) - res / 2 + 0.5, res / 2 - np.arange(res) - 0.5)
+    rays = np.stack([u / focal, v / focal, np.ones_like(u)], axis=-1)
+    clip = np.zeros((frames, res, res), dtype=np.uint8)
+    for t, (position, orientation) in enumerate(_poses(labels, frames, fps)):
+        world = rays @ orientation.T
+        down = world[..., 1] < -1e-6
+        dist = np.where(down, (position[1] + height) / np.where(down, -world[..., 1], 1), 0)
+        down &= dist > 0
+        x = position[0] + dist * world[..., 0]
+        z = position[2] + dist * world[..., 2]
+        tx = np.floor(x / texture_scale).astype(int) % texture_size
+        tz = np.floor(z / texture_scale).astype(int) % texture_size
+        # fade into the horizon
+        shade = np.clip(4 / (1 + dist), 0, 1)
+        clip[t] = np.where(down, texture[tz, tx] * shade, 0).astype(np.uint8)
+    return clip
+
+
+RENDERERS = {"dots": render_dots, "ground": render_ground}
+
+
+def random_labels(n, rng, max_velocity=2, max_rotation=30):
+    return np.concatenate([rng.uniform(-max_velocity, max_velocity, size=(n, 3)), rng.uniform(-max_rotation, max_rotation, size=(n, 3))], axis=1)
+
+
+def _write_clip(i, folder, labels, frames, res, fps, mode, seed):
+    # every clip has its own seed, the dataset does not depend on the number of processes
+    rng = np.random.default_rng([seed, i])
+    file = f"clip_{i:06d}.mp4"
+    clip = RENDERERS[mode](labels[i], frames=frames, res=res, fps=fps, rng=rng)
+    skvideo.io.vwrite(os.path.join(folder, file), clip, inputdict={'-r': str(fps)})
+    return file
+
+
+def write_synthetic_dataset(folder, n=64, frames=8, res=256, seed=0, mode="dots", fps=8, workers=0):
+    """
+    Renders n synthetic selfmotion clips (see render_dots / render_ground) as mp4 plus dataset.csv in the
+    schema SelfmotionDataGenerator expects (file_head, velX, velY, velZ, yaw, pitch, roll), using `workers`
+    processes. The output only depends on the seed. Returns the path of the csv.
+    """
+    os.makedirs(folder, exist_ok=True)
+    labels = random_labels(n, np.random.default_rng(seed))
+    write = functools.partial(_write_clip, folder=folder, labels=labels, frames=frames, res=res, fps=fps, mode=mode, seed=seed)
+    if workers > 0:
+        with mp.get_context("spawn").Pool(workers) as pool:
+            files = list(tqdm(pool.imap(write, range(n), chunksize=4), total=n))
+    else:
+        files = [write(i) for i in tqdm(range(n))]
+    data = pd.DataFrame(labels, columns=LABEL_COLUMNS)
+    data.insert(0, "file_head", files)
+    path = os.path.join(folder, "dataset.csv")
+    data.to_csv(path, index=False)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render a synthetic selfmotion dataset')
+
+    parser.add_argument('--out', help='output folder for the clips and dataset.csv', default="tmp/synthetic")
+    parser.add_argument('--clips', help='number of clips', default=256)
+    parser.add_argument('--frames', help='frames per clip', default=8)
+    parser.add_argument('--res', help='resolution of frames (res x res)', default=256)
+    parser.add_argument('--mode', help='dots (optic flow dot field) or ground (textured ground plane)', default="dots")
+    parser.add_argument('--fps', help='frame rate the velocities refer to', default=8)
+    parser.add_argument('--workers', help='number of rendering processes', default=4)
+    parser.add_argument('--seed', help='random seed', default=0)
+
+    args = parser.parse_args()
+
+    path = write_synthetic_dataset(args.out, n=int(args.clips), frames=int(args.frames), res=int(args.res), seed=int(args.seed), mode=args.mode, fps=int(args.fps), workers=int(args.workers))
+    print(f"saved as {path}")
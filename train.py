@@ -1,5 +1,9 @@
 from sm_vae import VAE
-from dataloader import SelfmotionDataGenerator
+from dataloader import SelfmotionDataGenerator, make_selfmotion_dataset
+from shards import ShardedSelfmotionDataGenerator, make_shard_dataset
+from distributed import is_worker, launch_workers, configure_worker, make_worker_dataset, write_folder, remove_write_folder
+from profiling import run_dir, parse_window, ProfilerCallback, python_profile
+import sys
 import argparse
 import pandas as pd
 from create_db import CustomDataGen
@@ -27,9 +31,37 @@ if __name__ == "__main__":
     parser.add_argument('--learning-rate', help='dimensionality of latent space', default=0.0001)
     parser.add_argument('--res', help='resolution of frames (res x res)', default=256)
     parser.add_argument('--suffix', help='optional, addition to filenames', default="")
+    parser.add_argument('--input-pipeline', help='sequence (SelfmotionDataGenerator) or tfdata (make_selfmotion_dataset)', default="sequence")
+    parser.add_argument('--normalize-in-model', help='Boolean whether the loaders yield uint8 clips that are normalized by the model', default="False")
+    parser.add_argument('--dataset', help='dataset csv (e.g. one written by synthetic.py)', default="/mnt/masc_home/kressal/datasets/selfmotion/20220930-134704_1_ws.csv")
+    parser.add_argument('--shards', help='optional, folder of a sharded dataset (see shards.py) used instead of the csv', default=None)
+    parser.add_argument('--resident-validation', help='optional, memory or mmap: decode the validation set once instead of every epoch', default=None)
+    parser.add_argument('--validation-freq', help='validate every n epochs', default=1)
+    parser.add_argument('--validation-samples', help='optional, validate on a fixed random subsample of this many clips', default=None)
+    parser.add_argument('--accumulation-steps', help='optional, split every batch into this many micro-batches and accumulate their gradients (explicit train step)', default=None)
+    parser.add_argument('--recompute-blocks', help='optional, comma separated conv layers (e.g. conv_1,conv_transpose_5) or all, recomputed in the backward pass to save memory', default=None)
+    parser.add_argument('--precision', help='float32, mixed_float16, mixed_bfloat16 or auto (mixed_float16 with a GPU, mixed_bfloat16 on CPU)', default="float32")
+    parser.add_argument('--workers', help='number of data parallel training processes on this host (MultiWorkerMirroredStrategy, see distributed.py)', default=1)
+    parser.add_argument('--checkpoint-dir', help='optional, folder for the checkpoints of this run, defaults to tmp/checkpoints/<name>', default=None)
+    parser.add_argument('--keep-checkpoints', help='number of most recent checkpoints kept besides the best one', default=3)
+    parser.add_argument('--resume', help='optional, checkpoint folder of an interrupted run to continue (the model arguments, resolution, normalization and batch size are taken from it)', default=None)
+    parser.add_argument('--histogram-freq', help='epochs between weight histograms in TensorBoard (0 disables them)', default=1)
+    parser.add_argument('--profile-steps', help='optional, window of train steps traced with tf.profiler, e.g. 10-20', default=None)
+    parser.add_argument('--profile-python', help='Boolean whether the Python side (data generator, callbacks) is profiled with cProfile', default="False")
+    parser.add_argument('--profile-dir', help='folder the profiles of this run are written to (profiles/<name>_<time>), see profiling.py summary', default="profiles")
+    parser.add_argument('--loader-workers', help='number of processes decoding batches ahead of training (0 decodes on the training thread)', default=0)
 
     args = parser.parse_args()
 
+    if args.resident_validation is not None and (args.input_pipeline == "tfdata" or args.shards is not None):
+        parser.error("--resident-validation decodes the validation clips of the dataset csv, it only works with --input-pipeline sequence and without --shards")
+
+    # with --workers N this process only launches the N workers, each of them runs this script again
+    workers = int(args.workers)
+    if workers > 1 and not is_worker():
+        sys.exit(launch_workers(workers, sys.argv))
+    strategy = configure_worker() if is_worker() else tf.distribute.get_strategy()
+
     print(args)
 
     # img_height, img_width = int(args.res), int(args.res)
@@ -48,8 +80,45 @@ if __name__ == "__main__":
 
     suffix = args.suffix if not args.suffix==None else ""
 
-    train_data = SelfmotionDataGenerator("/mnt/masc_home/kressal/datasets/selfmotion/20220930-134704_1_ws.csv", batch_size, video_dim, grayscale=True, shuffle=True)
-    val_data = SelfmotionDataGenerator("/mnt/masc_home/kressal/datasets/selfmotion/20220930-134704_1_ws.csv", batch_size, video_dim, grayscale=True, shuffle=True)
+    loader_workers = int(args.loader_workers)
+    normalize_in_model = args.normalize_in_model == "True"
+
+    dataset = args.dataset
+
+    if args.resume is not None:
+        # the loaders of a resumed run follow the checkpoint, not the command line
+        resumed = VAE.checkpoint_config(args.resume)
+        for flag, value, restored in [("--res", video_dim[1:], resumed["input_shape"][1:3]), ("--normalize-in-model", normalize_in_model, resumed["normalize_input"]), ("--batch-size", batch_size, resumed["batch_size"] or batch_size)]:
+            if value != restored:
+                print(f"{flag} is taken from the checkpoint: {restored} instead of {value}")
+        video_dim = list(resumed["input_shape"][:3])
+        normalize_in_model = resumed["normalize_input"]
+        batch_size = resumed["batch_size"] or batch_size
+
+    steps_per_epoch, validation_steps = None, None
+    if is_worker():
+        if args.shards is not None:
+            raise ValueError("--workers does not support --shards, use the dataset csv")
+        # batch_size is the global batch, every worker reads batch_size / workers clips of its own shard per step
+        train_data, steps_per_epoch = make_worker_dataset(dataset, batch_size, video_dim, args.input_pipeline, shuffle=True, normalize=not normalize_in_model, loader_workers=loader_workers)
+        val_data, validation_steps = make_worker_dataset(dataset, batch_size, video_dim, args.input_pipeline, shuffle=False, normalize=not normalize_in_model)
+        input_shape = video_dim + [1]
+    elif args.shards is not None and args.input_pipeline == "tfdata":
+        train_data = make_shard_dataset(args.shards, batch_size, shuffle=True, normalize=not normalize_in_model)
+        val_data = make_shard_dataset(args.shards, batch_size, shuffle=False, normalize=not normalize_in_model)
+        input_shape = ShardedSelfmotionDataGenerator(args.shards, batch_size).get_input_shape()
+    elif args.shards is not None:
+        train_data = ShardedSelfmotionDataGenerator(args.shards, batch_size, shuffle=True, normalize=not normalize_in_model)
+        val_data = ShardedSelfmotionDataGenerator(args.shards, batch_size, shuffle=False, normalize=not normalize_in_model)
+        input_shape = train_data.get_input_shape()
+    elif args.input_pipeline == "tfdata":
+        train_data = make_selfmotion_dataset(dataset, batch_size, video_dim, grayscale=True, shuffle=True, normalize=not normalize_in_model)
+        val_data = make_selfmotion_dataset(dataset, batch_size, video_dim, grayscale=True, shuffle=False, normalize=not normalize_in_model)
+        input_shape = video_dim + [1]
+    else:
+        train_data = SelfmotionDataGenerator(dataset, batch_size, video_dim, grayscale=True, shuffle=True, workers=loader_workers, normalize=not normalize_in_model)
+        val_data = SelfmotionDataGenerator(dataset, batch_size, video_dim, grayscale=True, shuffle=True, normalize=not normalize_in_model)
+        input_shape = train_data.get_input_shape()
 
     # path = "/home/kressal/datasets/selfmotion_vids"
     # files = [os.path.join(path,fn) for fn in os.listdir(path)]
@@ -70,37 +139,75 @@ if __name__ == "__main__":
 
     name = f"bs_{batch_size}#ep_{epochs}#gs_{bw}#rl_{recon_loss}#hw_{heading_weight}#klw_{kl_weight}#ld_{latent_dim}#lr_{learning_rate}#res_{video_dim[1]}#{suffix}"
 
-    vae = VAE(
-        input_shape=(train_data.get_input_shape()),
-        conv_filters=(64, 64, 64, 32, 16),
-        conv_kernels=([2,5,5], [2,4,4], [2,3,3], [2,3,3], [2,3,3]),
-        conv_strides=([1,2,2], [1,2,2], [2,2,2], [2,2,2], [2,1,1]),
-        latent_space_dim=latent_dim,
-        name=name,
-        kl_weight = kl_weight
-    )
-
-    # vae = VAE(
-    #     input_shape=train_data.input_shape(),
-    #     conv_filters=(64, 64, 64, 32, 16),
-    #     conv_kernels=([2,27,45], [2,2,2], [2,3,3], [2,3,3], [2,4,4]),
-    #     conv_strides=([1,9,15], [1,2,2], [2,2,2], [1,2,2], [1,1,1]),
-    #     latent_space_dim=420
-    # )
-
-    vae.summary()
-    # keras.utils.plot_model(vae.model, to_file="VAEdh.png", show_shapes=True)
-    # keras.utils.plot_model(vae.encoder, to_file="Encoder.png", show_shapes=True)
-    # keras.utils.plot_model(vae.decoder, to_file="Decoder.png", show_shapes=True)
-    # keras.utils.plot_model(vae.heading_decoder, to_file="Heading Decoder.png", show_shapes=True)
-    vae.compile(reconstruction_loss=recon_loss, heading_weight=heading_weight, learning_rate=learning_rate)
+    # variables have to be created in the strategy scope, the default strategy is a no-op
+    with strategy.scope():
+        if args.resume is not None:
+            vae = VAE.resume(args.resume)
+            name = vae.name
+        else:
+            vae = VAE(
+                input_shape=input_shape,
+                conv_filters=(64, 64, 64, 32, 16),
+                conv_kernels=([2,5,5], [2,4,4], [2,3,3], [2,3,3], [2,3,3]),
+                conv_strides=([1,2,2], [1,2,2], [2,2,2], [2,2,2], [2,1,1]),
+                latent_space_dim=latent_dim,
+                name=name,
+                kl_weight = kl_weight,
+                normalize_input=normalize_in_model,
+                precision=args.precision,
+                recompute_blocks=args.recompute_blocks if args.recompute_blocks in (None, "all") else args.recompute_blocks.split(",")
+            )
+
+        # vae = VAE(
+        #     input_shape=train_data.input_shape(),
+        #     conv_filters=(64, 64, 64, 32, 16),
+        #     conv_kernels=([2,27,45], [2,2,2], [2,3,3], [2,3,3], [2,4,4]),
+        #     conv_strides=([1,9,15], [1,2,2], [2,2,2], [1,2,2], [1,1,1]),
+        #     latent_space_dim=420
+        # )
+
+        vae.summary()
+        # keras.utils.plot_model(vae.model, to_file="VAEdh.png", show_shapes=True)
+        # keras.utils.plot_model(vae.encoder, to_file="Encoder.png", show_shapes=True)
+        # keras.utils.plot_model(vae.decoder, to_file="Decoder.png", show_shapes=True)
+        # keras.utils.plot_model(vae.heading_decoder, to_file="Heading Decoder.png", show_shapes=True)
+        vae.compile(reconstruction_loss=recon_loss, heading_weight=heading_weight, learning_rate=learning_rate, accumulation_steps=None if args.accumulation_steps is None else int(args.accumulation_steps))
     
     # vae.train(x_train, [x_train, y_train], batch_size, num_epochs=epochs, grayscale=bw, checkpoint_interval=100)
     # vae.train2(train_data, num_epochs=epochs, checkpoint_interval=int(epochs/10))
 
     # print(epochs)
 
-    vae.train(train_data, val_data, num_epochs=epochs, grayscale=bw, checkpoint_interval=1500)
-
-    vae.save(f"models/{name}")
-    print(f"saved as models/{name}")
\ No newline at end of file
+    profile_window = parse_window(args.profile_steps)
+    profile_python = args.profile_python == "True"
+    profile_dir = run_dir(f"{name}_{os.getpid()}" if is_worker() else name, args.profile_dir) if profile_window is not None or profile_python else None
+    callbacks = [ProfilerCallback(profile_dir, profile_window)] if profile_window is not None else []
+
+    with python_profile(profile_dir, enabled=profile_python):
+        vae.train(
+            train_data,
+            val_data,
+            num_epochs=epochs,
+            grayscale=bw,
+            checkpoint_interval=1500,
+            checkpoint_dir=args.checkpoint_dir,
+            keep_checkpoints=int(args.keep_checkpoints),
+            histogram_freq=int(args.histogram_freq),
+            resident_validation=None if is_worker() else args.resident_validation,
+            validation_freq=int(args.validation_freq),
+            validation_samples=None if args.validation_samples is None else int(args.validation_samples),
+            steps_per_epoch=steps_per_epoch,
+            validation_steps=validation_steps,
+            callbacks=callbacks
+        )
+
+    if is_worker():
+        vae.data_train, vae.data_val = dataset, dataset
+    # all workers save (see write_folder), only the chief keeps the model
+    save_folder = write_folder(f"models/{name}", vae.is_chief(), vae.task_id())
+    vae.save(save_folder)
+    remove_write_folder(save_folder, vae.is_chief())
+    if vae.is_chief():
+        print(f"saved as models/{name}")
+    if profile_dir is not None:
+        print(f"profiles in {profile_dir}, see python profiling.py summary {profile_dir}")
\ No newline at end of file